@@ -3,24 +3,193 @@
 import asyncio
 import logging
 
+import voluptuous as vol
+
 from .zengge_mesh import ZenggeMesh
-from .const import DOMAIN, CONF_MESH_NAME, CONF_MESH_PASSWORD, CONF_MESH_KEY
+from .zengge_connect import ZenggeConnect
+from .inventory import CloudInventory, inventory_place, apply_device_delta, INVENTORY_TTL
+from .zenggemeshlight import MESH_GROUP_BASE
+from .const import (
+    DOMAIN, CONF_MESH_NAME, CONF_MESH_PASSWORD, CONF_MESH_KEY, CONF_MESH_ID, CONF_GROUPS, CONF_MEMBERS, CONF_HOT_STANDBY, CONF_GATEWAYS,
+    CONF_INVENTORY_HASH, ATTR_GROUP, SIGNAL_GROUPS_UPDATED, SERVICE_ADD_TO_GROUP, SERVICE_REMOVE_FROM_GROUP, SERVICE_READ_GROUPS, SERVICE_REFRESH_DEVICES
+)
 
 from homeassistant.components.light import DOMAIN as LIGHT_DOMAIN
 from homeassistant.components.sensor import DOMAIN as SENSOR_DOMAIN
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.core import HomeAssistant
+from homeassistant.const import ATTR_ENTITY_ID, CONF_NAME, CONF_DEVICES, CONF_USERNAME, CONF_PASSWORD
+from homeassistant.core import HomeAssistant, ServiceCall
+from homeassistant.exceptions import HomeAssistantError
+from homeassistant.helpers import entity_registry as er
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers.dispatcher import async_dispatcher_send
+import homeassistant.helpers.config_validation as cv
 
 #PLATFORMS = [SENSOR_DOMAIN, LIGHT_DOMAIN, SWITCH_DOMAIN]
 PLATFORMS = [SENSOR_DOMAIN, LIGHT_DOMAIN]
 
 _LOGGER = logging.getLogger(__name__)
 
+GROUP_SERVICE_SCHEMA = vol.Schema({
+    vol.Required(ATTR_ENTITY_ID): cv.entity_ids,
+    vol.Required(ATTR_GROUP): vol.All(vol.Coerce(int), vol.Range(min=1, max=254)),
+    vol.Optional(CONF_NAME): cv.string,
+})
+
+READ_GROUPS_SERVICE_SCHEMA = vol.Schema({
+    vol.Optional(ATTR_ENTITY_ID): cv.entity_ids,
+})
+
 
 async def async_setup(hass, config):
     """Set up a skeleton component."""
 
     hass.data[DOMAIN] = {}
+
+    async def add_to_group(call: ServiceCall):
+        group = MESH_GROUP_BASE + call.data[ATTR_GROUP]
+        for entry_id, mesh_ids in _lights_by_entry(hass, call.data[ATTR_ENTITY_ID]).items():
+            mesh = hass.data[DOMAIN][entry_id]
+            for mesh_id in mesh_ids:
+                await mesh.async_add_group(mesh_id, group)
+            _update_groups(hass, entry_id, {mesh_id: {group} for mesh_id in mesh_ids}, add_only=True, name=call.data.get(CONF_NAME))
+
+    async def remove_from_group(call: ServiceCall):
+        group = MESH_GROUP_BASE + call.data[ATTR_GROUP]
+        for entry_id, mesh_ids in _lights_by_entry(hass, call.data[ATTR_ENTITY_ID]).items():
+            mesh = hass.data[DOMAIN][entry_id]
+            for mesh_id in mesh_ids:
+                await mesh.async_remove_group(mesh_id, group)
+            _update_groups(hass, entry_id, {mesh_id: {group} for mesh_id in mesh_ids}, remove_only=True)
+
+    async def read_groups(call: ServiceCall):
+        if ATTR_ENTITY_ID in call.data:
+            lights = _lights_by_entry(hass, call.data[ATTR_ENTITY_ID])
+        else:
+            lights = {entry_id: mesh.device_mesh_ids for entry_id, mesh in hass.data[DOMAIN].items()}
+        for entry_id, mesh_ids in lights.items():
+            mesh = hass.data[DOMAIN][entry_id]
+            memberships = {}
+            for mesh_id in mesh_ids:
+                try:
+                    memberships[mesh_id] = set(await mesh.async_get_groups(mesh_id))
+                except Exception as e:
+                    _LOGGER.warning('[%s][%d] Reading groups failed - [%s] %s', mesh.mesh_name, mesh_id, type(e).__name__, e)
+            _update_groups(hass, entry_id, memberships)
+
+    hass.services.async_register(DOMAIN, SERVICE_ADD_TO_GROUP, add_to_group, GROUP_SERVICE_SCHEMA)
+    hass.services.async_register(DOMAIN, SERVICE_REMOVE_FROM_GROUP, remove_from_group, GROUP_SERVICE_SCHEMA)
+    hass.services.async_register(DOMAIN, SERVICE_READ_GROUPS, read_groups, READ_GROUPS_SERVICE_SCHEMA)
+
+    async def refresh_devices(call: ServiceCall):
+        for entry in hass.config_entries.async_entries(DOMAIN):
+            await _async_refresh_devices(hass, entry, max_age=0)
+
+    hass.services.async_register(DOMAIN, SERVICE_REFRESH_DEVICES, refresh_devices)
+
+    return True
+
+
+def _lights_by_entry(hass: HomeAssistant, entity_ids: list) -> dict:
+    """Map light entity ids to the mesh ids of the lights, by config entry"""
+    registry = er.async_get(hass)
+    lights = {}
+    for entity_id in entity_ids:
+        entity = registry.async_get(entity_id)
+        mesh_id = None
+        if entity is not None and entity.platform == DOMAIN and entity.config_entry_id in hass.data[DOMAIN]:
+            try:
+                mesh_id = int(entity.unique_id.replace('zenggemesh-', '', 1))
+            except ValueError:
+                pass
+        if mesh_id is None:
+            raise HomeAssistantError(f'{entity_id} is not a Zengge mesh light')
+        lights.setdefault(entity.config_entry_id, []).append(mesh_id)
+    return lights
+
+
+def _update_groups(hass: HomeAssistant, entry_id: str, memberships: dict, add_only: bool = False, remove_only: bool = False, name: str = None):
+    """
+    Apply group memberships to the groups cached in the config entry and update the group lights when they changed.
+
+    Args :
+        memberships: The group addresses per mesh id. Unless add_only or remove_only is set, these replace the known groups of the mesh id.
+    """
+    entry = hass.config_entries.async_get_entry(entry_id)
+    groups = {group[CONF_MESH_ID]: dict(group, **{CONF_MEMBERS: set(group[CONF_MEMBERS])}) for group in entry.data.get(CONF_GROUPS, [])}
+
+    for mesh_id, member_of in memberships.items():
+        for group_address, group in groups.items():
+            if remove_only and group_address in member_of:
+                group[CONF_MEMBERS].discard(mesh_id)
+            elif not remove_only and not add_only and group_address not in member_of:
+                group[CONF_MEMBERS].discard(mesh_id)
+        if remove_only:
+            continue
+        for group_address in member_of:
+            group = groups.setdefault(group_address, {CONF_MESH_ID: group_address, CONF_NAME: None, CONF_MEMBERS: set()})
+            group[CONF_MEMBERS].add(mesh_id)
+            if name is not None:
+                group[CONF_NAME] = name
+
+    for group_address, group in groups.items():
+        if group[CONF_NAME] is None:
+            group[CONF_NAME] = 'Group %d' % (group_address - MESH_GROUP_BASE)
+
+    new_groups = [
+        {CONF_MESH_ID: group_address, CONF_NAME: group[CONF_NAME], CONF_MEMBERS: sorted(group[CONF_MEMBERS])}
+        for group_address, group in sorted(groups.items())
+        if group[CONF_MEMBERS]
+    ]
+    if new_groups == entry.data.get(CONF_GROUPS, []):
+        return
+
+    _LOGGER.info('[%s] Mesh groups changed: %s', entry.title, new_groups)
+    hass.config_entries.async_update_entry(entry, data={**entry.data, CONF_GROUPS: new_groups})
+    # No reload, that would drop the mesh connection for a while
+    hass.data[DOMAIN][entry_id].set_groups(new_groups)
+    async_dispatcher_send(hass, SIGNAL_GROUPS_UPDATED.format(entry_id), new_groups)
+
+
+async def _async_refresh_devices(hass: HomeAssistant, entry: ConfigEntry, max_age: float = INVENTORY_TTL) -> bool:
+    """
+    Apply the changes in the cloud inventory to the devices of the entry and reload the entry when there are any.
+
+    Args :
+        max_age: Seconds a stored inventory is used without asking the cloud, 0 to always ask
+    """
+    if CONF_USERNAME not in entry.data:
+        return False
+    zengge_connect = ZenggeConnect(async_get_clientsession(hass), entry.data[CONF_USERNAME], entry.data[CONF_PASSWORD])
+    try:
+        inventory = await CloudInventory(hass, entry.data[CONF_USERNAME], entry.data[CONF_PASSWORD]).async_get(zengge_connect, max_age)
+    except Exception as e:
+        _LOGGER.warning('[%s] Refreshing devices failed - [%s] %s', entry.title, type(e).__name__, e)
+        return False
+    place = inventory_place(inventory, entry.unique_id)
+    if place is None:
+        _LOGGER.warning('[%s] Place %s is no longer in the Zengge cloud account', entry.title, entry.unique_id)
+        return False
+    if place['hash'] == entry.data.get(CONF_INVENTORY_HASH):
+        return False
+
+    devices, added, removed, changed = apply_device_delta(entry.data[CONF_DEVICES], place['devices'])
+    credentials = place['place']
+    data = {
+        **entry.data,
+        CONF_MESH_NAME: credentials['meshKey'],
+        CONF_MESH_PASSWORD: credentials['meshPassword'],
+        CONF_MESH_KEY: credentials['meshLTK'],
+        CONF_DEVICES: devices,
+        CONF_INVENTORY_HASH: place['hash'],
+    }
+    reload = added or removed or changed or any(data[key] != entry.data.get(key) for key in (CONF_MESH_NAME, CONF_MESH_PASSWORD, CONF_MESH_KEY))
+    hass.config_entries.async_update_entry(entry, data=data)
+    if not reload:
+        return False
+
+    _LOGGER.info('[%s] Devices changed in the cloud - added: %s, removed: %s, changed: %s', entry.title, added, removed, changed)
+    hass.async_create_task(hass.config_entries.async_reload(entry.entry_id))
     return True
 
 
@@ -29,13 +198,29 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
 
     _LOGGER.info('setup config flow entry %s', entry.data)
 
-    mesh = ZenggeMesh(hass, entry.data[CONF_MESH_NAME], entry.data[CONF_MESH_PASSWORD], entry.data[CONF_MESH_KEY])
+    mesh = ZenggeMesh(hass, entry.data[CONF_MESH_NAME], entry.data[CONF_MESH_PASSWORD], entry.data[CONF_MESH_KEY],
+                      hot_standby=entry.options.get(CONF_HOT_STANDBY, False), gateways=entry.options.get(CONF_GATEWAYS, 0))
+    mesh.set_groups(entry.data.get(CONF_GROUPS, []))
+    options = dict(entry.options)
+
+    async def _async_entry_updated(hass: HomeAssistant, entry: ConfigEntry):
+        """Reload the entry to apply changed options, data changes take care of their own reload"""
+        if dict(entry.options) != options:
+            await hass.config_entries.async_reload(entry.entry_id)
+
+    entry.async_on_unload(entry.add_update_listener(_async_entry_updated))
+    await mesh.async_load()
 
     # Make `mesh` accessible for all platforms
     hass.data[DOMAIN][entry.entry_id] = mesh
 
     await hass.config_entries.async_forward_entry_setups(entry, PLATFORMS)
 
+    # Lights show their stored state meanwhile, no need to wait for the first update interval
+    hass.async_create_task(mesh.async_connect())
+    # Only asks the cloud once the stored inventory is outdated
+    hass.async_create_task(_async_refresh_devices(hass, entry))
+
     return True
 
 
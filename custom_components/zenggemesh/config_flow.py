@@ -5,22 +5,25 @@ import logging
 
 import voluptuous as vol
 
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.components import bluetooth
 from homeassistant import config_entries
 from homeassistant.const import (
     CONF_USERNAME,
-    CONF_PASSWORD
+    CONF_PASSWORD,
+    CONF_DEVICES
 )
-from .const import DOMAIN, CONF_MESH_NAME, CONF_MESH_PASSWORD, CONF_MESH_KEY
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from .const import DOMAIN, CONF_MESH_NAME, CONF_MESH_PASSWORD, CONF_MESH_KEY, CONF_INVENTORY_HASH, CONF_PLACE, CONF_HOT_STANDBY, CONF_GATEWAYS
 from .zengge_connect import ZenggeConnect
+from .inventory import CloudInventory, inventory_place
 
 _LOGGER = logging.getLogger(__name__)
 
 
-def create_zengge_connect_object(username, password) -> ZenggeConnect:
-    return ZenggeConnect(username, password)
+def create_zengge_connect_object(hass: HomeAssistant, username, password) -> ZenggeConnect:
+    return ZenggeConnect(async_get_clientsession(hass), username, password)
 
 
 class ZenggeMeshFlowHandler(config_entries.ConfigFlow, domain=DOMAIN):
@@ -121,227 +124,77 @@ class ZenggeMeshFlowHandler(config_entries.ConfigFlow, domain=DOMAIN):
         )
 
     async def async_step_zengge_connect(self, user_input: Optional[Mapping] = None):
-        devices = [
-            {
-                "mesh_id": 12,
-                "name": "Dining Near_Window",
-                "mac": "a4:c1:38:90:49:8a",
-                "model": "unknown",
-                "manufacturer": "unknown",
-                "firmware": "unknown",
-                "hardware": None,
-                "type": "light"
-            },
-            {
-                "mesh_id": 11,
-                "name": "Dining Near_Living",
-                "mac": "a4:c1:38:8a:72:97",
-                "model": "unknown",
-                "manufacturer": "unknown",
-                "firmware": "unknown",
-                "hardware": None,
-                "type": "light"
-            },
-            {
-                "mesh_id": 42,
-                "name": "Dhyaan Bottom_Left",
-                "mac": "a4:c1:38:90:9c:8a",
-                "model": "unknown",
-                "manufacturer": "unknown",
-                "firmware": "unknown",
-                "hardware": None,
-                "type": "light"
-            }
-            # {
-            #     "mesh_id": 45,
-            #     "name": "Dhyaan Bottom_Right",
-            #     "mac": "a4:c1:38:96:56:6e",
-            #     "model": "unknown",
-            #     "manufacturer": "unknown",
-            #     "firmware": "unknown",
-            #     "hardware": None,
-            #     "type": "light"
-            # },
-            # {
-            #     "mesh_id": 46,
-            #     "name": "Dhyaan Center",
-            #     "mac": "a4:c1:38:8a:4f:97",
-            #     "model": "unknown",
-            #     "manufacturer": "unknown",
-            #     "firmware": "unknown",
-            #     "hardware": None,
-            #     "type": "light"
-            # },
-            # {
-            #     "mesh_id": 43,
-            #     "name": "Dhyaan Top_Left",
-            #     "mac": "a4:c1:38:96:8e:6e",
-            #     "model": "unknown",
-            #     "manufacturer": "unknown",
-            #     "firmware": "unknown",
-            #     "hardware": None,
-            #     "type": "light"
-            # },
-            # {
-            #     "mesh_id": 44,
-            #     "name": "Dhyaan Top_Right",
-            #     "mac": "a4:c1:38:8a:5a:97",
-            #     "model": "unknown",
-            #     "manufacturer": "unknown",
-            #     "firmware": "unknown",
-            #     "hardware": None,
-            #     "type": "light"
-            # },
-            # {
-            #     "mesh_id": 53,
-            #     "name": "Master Bathroom",
-            #     "mac": "",
-            #     "model": "unknown",
-            #     "manufacturer": "unknown",
-            #     "firmware": "unknown",
-            #     "hardware": None,
-            #     "type": "light"
-            # },
-            # {
-            #     "mesh_id": 32774,
-            #     "name": "Lounge",
-            #     "mac": "",
-            #     "model": "unknown",
-            #     "manufacturer": "unknown",
-            #     "firmware": "unknown",
-            #     "hardware": None,
-            #     "type": "light"
-            # },
-            # {
-            #     "mesh_id": 32775,
-            #     "name": "Kitchen",
-            #     "mac": "",
-            #     "model": "unknown",
-            #     "manufacturer": "unknown",
-            #     "firmware": "unknown",
-            #     "hardware": None,
-            #     "type": "light"
-            # },
-            # {
-            #     "mesh_id": 32776,
-            #     "name": "Sink",
-            #     "mac": "",
-            #     "model": "unknown",
-            #     "manufacturer": "unknown",
-            #     "firmware": "unknown",
-            #     "hardware": None,
-            #     "type": "light"
-            # },
-            # {
-            #     "mesh_id": 32769,
-            #     "name": "Living",
-            #     "mac": "",
-            #     "model": "unknown",
-            #     "manufacturer": "unknown",
-            #     "firmware": "unknown",
-            #     "hardware": None,
-            #     "type": "light"
-            # },
-            # {
-            #     "mesh_id": 32782,
-            #     "name": "Dhyaan Room",
-            #     "mac": "",
-            #     "model": "unknown",
-            #     "manufacturer": "unknown",
-            #     "firmware": "unknown",
-            #     "hardware": None,
-            #     "type": "light"
-            # },
-            # {
-            #     "mesh_id": 32779,
-            #     "name": "Neel Room",
-            #     "mac": "",
-            #     "model": "unknown",
-            #     "manufacturer": "unknown",
-            #     "firmware": "unknown",
-            #     "hardware": None,
-            #     "type": "light"
-            # },
-            # {
-            #     "mesh_id": 32772,
-            #     "name": "Master Bedroom",
-            #     "mac": "",
-            #     "model": "unknown",
-            #     "manufacturer": "unknown",
-            #     "firmware": "unknown",
-            #     "hardware": None,
-            #     "type": "light"
-            # },
-            # {
-            #     "mesh_id": 32773,
-            #     "name": "Entrance Hallway",
-            #     "mac": "",
-            #     "model": "unknown",
-            #     "manufacturer": "unknown",
-            #     "firmware": "unknown",
-            #     "hardware": None,
-            #     "type": "light"
-            # },
-            # {
-            #     "mesh_id": 32781,
-            #     "name": "Hallway",
-            #     "mac": "",
-            #     "model": "unknown",
-            #     "manufacturer": "unknown",
-            #     "firmware": "unknown",
-            #     "hardware": None,
-            #     "type": "light"
-            # },
-            # {
-            #     "mesh_id": 32777,
-            #     "name": "Dining Room",
-            #     "mac": "",
-            #     "model": "unknown",
-            #     "manufacturer": "unknown",
-            #     "firmware": "unknown",
-            #     "hardware": None,
-            #     "type": "light"
-            # },
-            # {
-            #     "mesh_id": 32778,
-            #     "name": "Alfresco",
-            #     "mac": "",
-            #     "model": "unknown",
-            #     "manufacturer": "unknown",
-            #     "firmware": "unknown",
-            #     "hardware": None,
-            #     "type": "light"
-            # },
-            # {
-            #     "mesh_id": 32780,
-            #     "name": "Guest Bedroom",
-            #     "mac": "",
-            #     "model": "unknown",
-            #     "manufacturer": "unknown",
-            #     "firmware": "unknown",
-            #     "hardware": None,
-            #     "type": "light"
-            # },
-            # {
-            #     "mesh_id": 65535,
-            #     "name": "House Lights",
-            #     "mac": "",
-            #     "model": "unknown",
-            #     "manufacturer": "unknown",
-            #     "firmware": "unknown",
-            #     "hardware": None,
-            #     "type": "light"
-            # }
-            ]
+        errors = {}
+        username: str = ''
+        password: str = ''
+
+        if user_input is not None:
+            username = user_input.get(CONF_USERNAME)
+            password = user_input.get(CONF_PASSWORD)
+
+            zengge_connect = create_zengge_connect_object(self.hass, username, password)
+            try:
+                inventory = await CloudInventory(self.hass, username, password).async_get(zengge_connect)
+            except Exception as e:
+                _LOGGER.error('Can not login to Zengge cloud [%s] %s', type(e).__name__, e)
+                errors[CONF_PASSWORD] = 'cannot_connect'
+            else:
+                configured = self._async_current_ids()
+                places = [place for place in inventory['places'] if place['place']['placeUniID'] not in configured]
+                if not places:
+                    return self.async_abort(reason='already_configured')
+
+                # Every place is its own mesh, the other places get their own entry
+                for place in places[1:]:
+                    self.hass.async_create_task(self.hass.config_entries.flow.async_init(
+                        DOMAIN,
+                        context={'source': config_entries.SOURCE_IMPORT},
+                        data={CONF_USERNAME: username, CONF_PASSWORD: password, CONF_PLACE: place['place']['placeUniID']}
+                    ))
+                return await self._async_create_place_entry(username, password, places[0])
+
+        return self.async_show_form(
+            step_id='zengge_connect',
+            data_schema=vol.Schema({
+                vol.Required(CONF_USERNAME, default=username): str,
+                vol.Required(CONF_PASSWORD, default=password): str
+            }),
+            errors=errors,
+        )
+
+    async def async_step_import(self, import_data: Mapping):
+        """Add a further place of a cloud account, started from step zengge_connect"""
+        username = import_data[CONF_USERNAME]
+        password = import_data[CONF_PASSWORD]
+
+        zengge_connect = create_zengge_connect_object(self.hass, username, password)
+        try:
+            # The inventory was just downloaded by step zengge_connect
+            inventory = await CloudInventory(self.hass, username, password).async_get(zengge_connect)
+        except Exception as e:
+            _LOGGER.error('Can not login to Zengge cloud [%s] %s', type(e).__name__, e)
+            return self.async_abort(reason='cannot_connect')
+
+        place = inventory_place(inventory, import_data[CONF_PLACE])
+        if place is None:
+            return self.async_abort(reason='no_devices_found')
+        return await self._async_create_place_entry(username, password, place)
+
+    async def _async_create_place_entry(self, username: str, password: str, place: Mapping):
+        credentials = place['place']
+        await self.async_set_unique_id(credentials['placeUniID'])
+        self._abort_if_unique_id_configured()
 
         data = {
-            CONF_MESH_NAME: "Gsense_Mesh",
-            CONF_MESH_PASSWORD: "321",
-            CONF_MESH_KEY: "unknown",
-            'devices': devices
+            CONF_MESH_NAME: credentials['meshKey'],
+            CONF_MESH_PASSWORD: credentials['meshPassword'],
+            CONF_MESH_KEY: credentials['meshLTK'],
+            CONF_USERNAME: username,
+            CONF_PASSWORD: password,
+            CONF_DEVICES: place['devices'],
+            CONF_INVENTORY_HASH: place['hash'],
         }
-
-        return self.async_create_entry(title='Zengge Cloud', data=data)
+        return self.async_create_entry(title=credentials.get('displayName') or 'Zengge Cloud', data=data)
 
     async def async_step_mesh_info(self, user_input: Optional[Mapping] = None):
 
@@ -386,11 +239,11 @@ class ZenggeMeshFlowHandler(config_entries.ConfigFlow, domain=DOMAIN):
         """Forward result of device select form to step user"""
         return await self.async_step_user(user_input)
 
-    # @staticmethod
-    # @callback
-    # def async_get_options_flow(config_entry):
-    #     """Define the config flow to handle options."""
-    #     return UpnpOptionsFlowHandler(config_entry)
+    @staticmethod
+    @callback
+    def async_get_options_flow(config_entry):
+        """Define the config flow to handle options."""
+        return ZenggeMeshOptionsFlowHandler(config_entry)
 
     async def _async_create_entry_from_discovery(
             self,
@@ -443,3 +296,22 @@ class ZenggeMeshFlowHandler(config_entries.ConfigFlow, domain=DOMAIN):
 #     """Return if there are devices that can be discovered."""
 #     devices = await DeviceScanner.find_devices()
 #     return len(devices) > 0
+
+
+class ZenggeMeshOptionsFlowHandler(config_entries.OptionsFlow):
+    """Handle the options of a Zengge mesh."""
+
+    def __init__(self, config_entry: ConfigEntry):
+        self.config_entry = config_entry
+
+    async def async_step_init(self, user_input: Optional[Mapping] = None):
+        if user_input is not None:
+            return self.async_create_entry(title='', data=user_input)
+
+        return self.async_show_form(
+            step_id='init',
+            data_schema=vol.Schema({
+                vol.Optional(CONF_HOT_STANDBY, default=self.config_entry.options.get(CONF_HOT_STANDBY, False)): bool,
+                vol.Optional(CONF_GATEWAYS, default=self.config_entry.options.get(CONF_GATEWAYS, 0)): vol.All(vol.Coerce(int), vol.Range(min=0, max=3)),
+            }),
+        )
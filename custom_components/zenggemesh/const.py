@@ -10,3 +10,19 @@ CONFIG_DEVICES = 'devices'
 CONF_MANUFACTURER = 'manufacturer'
 CONF_MODEL = 'model'
 CONF_FIRMWARE = 'firmware'
+CONF_GROUPS = 'groups'
+CONF_MEMBERS = 'members'
+CONF_HOT_STANDBY = 'hot_standby'
+CONF_GATEWAYS = 'gateways'
+CONF_INVENTORY_HASH = 'inventory_hash'
+CONF_PLACE = 'place'
+
+ATTR_GROUP = 'group'
+
+#: Sent with the new groups of a config entry, format with the entry id
+SIGNAL_GROUPS_UPDATED = DOMAIN + '_groups_{}'
+
+SERVICE_ADD_TO_GROUP = 'add_to_group'
+SERVICE_REMOVE_FROM_GROUP = 'remove_from_group'
+SERVICE_READ_GROUPS = 'read_groups'
+SERVICE_REFRESH_DEVICES = 'refresh_devices'
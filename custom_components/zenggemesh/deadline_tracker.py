@@ -0,0 +1,116 @@
+"""Per key expiry with a single timer"""
+import asyncio
+import heapq
+
+
+class DeadlineTracker:
+    """
+    Calls expired_callback for a key once it has not been refreshed for timeout seconds.
+
+    The heap holds at most one entry per key, with the deadline at the time it
+    was pushed. Refreshing a key only moves its deadline in a dict; when the
+    timer reaches an entry whose deadline has moved, the entry is pushed again
+    with the new deadline. Refreshing is O(1), only one timer is scheduled and it
+    fires exactly when the earliest deadline passes.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, timeout: float, expired_callback):
+        """
+        Args :
+            timeout: Seconds after the last refresh a key expires
+            expired_callback: Called with the key when it expires, from the event loop
+        """
+        self._loop = loop
+        self._timeout = timeout
+        self._expired_callback = expired_callback
+        self._deadlines = {}
+        self._heap = []
+        self._queued = set()  # Keys with an entry in the heap
+        self._timer = None
+        self._timer_at = None
+
+    def refresh(self, key):
+        """(Re)start the timeout of key"""
+        deadline = self._loop.time() + self._timeout
+        self._deadlines[key] = deadline
+        if key not in self._queued:
+            self._queued.add(key)
+            heapq.heappush(self._heap, (deadline, key))
+            self._schedule()
+
+    def earliest(self):
+        """The earliest deadline in loop time, or None when no key is tracked"""
+        heap = self._heap
+        while heap:
+            deadline, key = heap[0]
+            current = self._deadlines.get(key)
+            if current == deadline:
+                return deadline
+            heapq.heappop(heap)
+            if current is None:
+                self._queued.discard(key)
+            else:
+                heapq.heappush(heap, (current, key))
+        return None
+
+    def due(self, before: float) -> list:
+        """The keys with a deadline before the given loop time, walking only that part of the heap"""
+        heap = self._heap
+        keys = []
+        pending = [(heap[0], 0)] if heap else []
+        while pending:
+            (deadline, key), index = heapq.heappop(pending)
+            # Heap entries never have a later deadline than the key, so the rest of this branch is not due
+            if deadline >= before:
+                continue
+            current = self._deadlines.get(key)
+            if current is not None and current < before:
+                keys.append(key)
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < len(heap):
+                    heapq.heappush(pending, (heap[child], child))
+        return keys
+
+    def clear(self):
+        self._deadlines.clear()
+        self._heap.clear()
+        self._queued.clear()
+        self.cancel()
+
+    def cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = None
+        self._timer_at = None
+
+    def _schedule(self):
+        if not self._heap:
+            self.cancel()
+            return
+        when = self._heap[0][0]
+        if self._timer is not None and self._timer_at <= when:
+            return
+        self.cancel()
+        self._timer_at = when
+        self._timer = self._loop.call_at(when, self._fire)
+
+    def _fire(self):
+        self._timer = None
+        self._timer_at = None
+        now = self._loop.time()
+        heap = self._heap
+        expired = []
+        while heap and heap[0][0] <= now:
+            _, key = heapq.heappop(heap)
+            deadline = self._deadlines.get(key)
+            if deadline is None:
+                self._queued.discard(key)
+            elif deadline > now:
+                heapq.heappush(heap, (deadline, key))
+            else:
+                self._queued.discard(key)
+                del self._deadlines[key]
+                expired.append(key)
+        self._schedule()
+        for key in expired:
+            self._expired_callback(key)
@@ -0,0 +1,144 @@
+"""Cache of the device inventory in the Zengge cloud"""
+import hashlib
+import json
+import logging
+import time
+from typing import Mapping
+
+from homeassistant.const import CONF_NAME, CONF_MAC
+from homeassistant.core import HomeAssistant
+from homeassistant.helpers.storage import Store
+
+from .const import DOMAIN, CONF_MESH_ID, CONF_MANUFACTURER, CONF_MODEL, CONF_FIRMWARE
+from .zengge_connect import ZenggeConnect
+
+_LOGGER = logging.getLogger(__name__)
+
+INVENTORY_STORAGE_VERSION = 1
+#: Seconds a downloaded inventory is used before asking the cloud again
+INVENTORY_TTL = 24 * 3600
+#: Light type (see light.supported_color_modes_for) per deviceType of the cloud
+DEVICE_TYPE_LIGHTS = {
+    0x41: 'light color temperature dimming',  # RGB + CCT
+    0x42: 'light color dimming',  # RGB + W
+    0x43: 'light color dimming',  # RGB
+    0x44: 'light temperature dimming',  # CCT
+    0x45: 'light dimming',  # Single color
+}
+#: Unknown devices only get on/off, that works for plugs and lights alike
+DEVICE_TYPE_DEFAULT = 'light'
+
+
+def device_type_from_cloud(device_type) -> str:
+    """The light type for the deviceType of a cloud device"""
+    try:
+        return DEVICE_TYPE_LIGHTS[int(device_type)]
+    except (KeyError, TypeError, ValueError):
+        _LOGGER.warning('Unknown Zengge device type %s, only on/off is supported', device_type)
+        return DEVICE_TYPE_DEFAULT
+
+
+def device_from_cloud(device: Mapping) -> dict:
+    """Map a device of the Zengge cloud to the device config of a light"""
+    mac = device['macAddress'].replace(':', '')
+    return {
+        CONF_MESH_ID: int(device['meshAddress']),
+        CONF_NAME: device['displayName'],
+        # Uppercase, like the addresses of the Bluetooth integration
+        CONF_MAC: ':'.join(mac[i:i + 2] for i in range(0, 12, 2)).upper() if mac else '',
+        CONF_MODEL: device.get('deviceType') or 'unknown',
+        CONF_MANUFACTURER: 'Zengge',
+        CONF_FIRMWARE: device.get('firmwareVer') or 'unknown',
+        'type': device_type_from_cloud(device.get('deviceType')),
+    }
+
+
+def inventory_hash(place: Mapping, devices: list) -> str:
+    return hashlib.sha256(json.dumps([place, devices], sort_keys=True).encode()).hexdigest()
+
+
+def inventory_place(inventory: Mapping, place_id: str):
+    """The place with the given placeUniID in the inventory, or None"""
+    for place in inventory['places']:
+        if place['place']['placeUniID'] == place_id:
+            return place
+    return None
+
+
+def apply_device_delta(devices: list, cloud_devices: list) -> tuple:
+    """
+    Args :
+        devices: The device configs of a config entry
+        cloud_devices: The device configs from the cloud inventory
+
+    Returns :
+        (devices, added, removed, changed): the new device configs, known devices keep their
+        order and local fields, and the mesh ids of the added, removed and changed devices
+    """
+    cloud = {device[CONF_MESH_ID]: device for device in cloud_devices}
+    updated, removed, changed = [], [], []
+    for device in devices:
+        cloud_device = cloud.pop(device[CONF_MESH_ID], None)
+        if cloud_device is None:
+            removed.append(device[CONF_MESH_ID])
+            continue
+        merged = {**device, **cloud_device}
+        if merged != device:
+            changed.append(device[CONF_MESH_ID])
+        updated.append(merged)
+    updated.extend(cloud.values())
+    return updated, list(cloud), removed, changed
+
+
+class CloudInventory:
+    """The places and their devices of a cloud account, stored in the Home Assistant storage dir"""
+
+    def __init__(self, hass: HomeAssistant, username: str, password: str):
+        account = f'{username.lower()}:{password}'.encode()
+        self._store = Store(hass, INVENTORY_STORAGE_VERSION, f'{DOMAIN}.inventory_{hashlib.sha1(username.lower().encode()).hexdigest()[:16]}')
+        # Only hand out the cache to the same credentials it was downloaded with
+        self._account = hashlib.sha256(account).hexdigest()
+        self._data = None
+
+    async def async_get(self, zengge_connect: ZenggeConnect, max_age: float = INVENTORY_TTL) -> dict:
+        """
+        Args :
+            max_age: Seconds a stored inventory is used without asking the cloud, 0 to always ask
+
+        Returns :
+            A dict with the 'places' of the account, when they were downloaded as 'updated' and
+            the cloud 'server' that accepted the account.
+            Every place is a dict with the 'place' (mesh credentials), its light configs
+            as 'devices' and their 'hash'.
+        """
+        if self._data is None:
+            data = await self._store.async_load()
+            self._data = data if data and data.get('account') == self._account and 'places' in data else {}
+        if self._data and time.time() - self._data['updated'] < max_age:
+            return self._data
+
+        if zengge_connect.server is None:
+            zengge_connect.server = self._data.get('server')
+        try:
+            places = [dict(place) for place in await zengge_connect.places()]
+            places_devices = await zengge_connect.places_devices()
+        except Exception as e:
+            if not self._data:
+                raise
+            _LOGGER.warning('Refreshing the Zengge cloud inventory failed, using the one from %s - [%s] %s',
+                            time.ctime(self._data['updated']), type(e).__name__, e)
+            return self._data
+        inventory = []
+        for place, devices in zip(places, places_devices):
+            place.pop('devices', None)
+            devices = [device_from_cloud(device) for device in devices]
+            inventory.append({'place': place, 'devices': devices, 'hash': inventory_hash(place, devices)})
+
+        self._data = {
+            'account': self._account,
+            'updated': time.time(),
+            'server': zengge_connect.server,
+            'places': inventory,
+        }
+        await self._store.async_save(self._data)
+        return self._data
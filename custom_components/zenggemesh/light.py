@@ -2,9 +2,12 @@
 from __future__ import annotations
 
 import logging
-import math
 
 from .zengge_mesh import ZenggeMesh
+from .zenggemeshlight import DeviceStatus, PRIORITY_INTERACTIVE, PRIORITY_AUTOMATION, MESH_ADDRESS_BROADCAST
+from .zenggemeshlight.conversions import (
+    MIN_MIREDS, MAX_MIREDS, brightness_to_device, device_to_brightness, mired_to_cct, cct_to_mired
+)
 from typing import Any, Dict, Optional
 
 import homeassistant.util.color as color_util
@@ -12,14 +15,19 @@ from homeassistant.helpers.typing import StateType
 from homeassistant.helpers.entity import DeviceInfo, Entity
 
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.core import HomeAssistant, callback
+from homeassistant.core import HomeAssistant, callback, Event
 from homeassistant.components.light import (
     ATTR_BRIGHTNESS,
     ATTR_COLOR_TEMP,
     ATTR_RGB_COLOR,
+    DOMAIN as LIGHT_DOMAIN,
     LightEntity,
-    ColorMode
+    ColorMode,
+    filter_supported_color_modes
 )
+from homeassistant.helpers import entity_registry as er
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
+from homeassistant.helpers.event import async_track_state_change_event
 from homeassistant.helpers.update_coordinator import (
     CoordinatorEntity,
 )
@@ -32,7 +40,7 @@ from homeassistant.const import (
     STATE_OFF,
     STATE_UNAVAILABLE,
 )
-from .const import DOMAIN, CONF_MESH_ID, CONF_MANUFACTURER, CONF_MODEL, CONF_FIRMWARE
+from .const import DOMAIN, CONF_MESH_ID, CONF_MANUFACTURER, CONF_MODEL, CONF_FIRMWARE, CONF_GROUPS, CONF_MEMBERS, SIGNAL_GROUPS_UPDATED
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -42,6 +50,7 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry, async_add_e
 
     mesh = hass.data[DOMAIN][entry.entry_id]
     lights = []
+    light_types = {}
     for device in entry.data[CONF_DEVICES]:
         # Skip non lights
         if 'light' not in device['type']:
@@ -53,91 +62,78 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry, async_add_e
         if CONF_FIRMWARE not in device:
             device[CONF_FIRMWARE] = None
 
-        type_string = ''
-        supported_color_modes = set()
-
-        if 'type' in device:
-            type_string = device['type']
-
-        if 'color' in type_string:
-            supported_color_modes.add(ColorMode.RGB)
-
-        if 'temperature' in type_string:
-            supported_color_modes.add(ColorMode.COLOR_TEMP)
+        type_string = device.get('type', '')
+        light_types[device[CONF_MESH_ID]] = type_string
 
-        if 'dimming' in type_string:
-            supported_color_modes.add(ColorMode.BRIGHTNESS)
-
-        if len(supported_color_modes) == 0:
-            supported_color_modes.add(ColorMode.ONOFF)
-
-        light = ZenggeLight(mesh, device[CONF_MAC], device[CONF_MESH_ID], device[CONF_NAME], supported_color_modes,
+        light = ZenggeLight(mesh, device[CONF_MAC], device[CONF_MESH_ID], device[CONF_NAME], supported_color_modes_for(type_string),
                           device[CONF_MANUFACTURER], device[CONF_MODEL], device[CONF_FIRMWARE])
         _LOGGER.info('Setup light [%d] %s', device[CONF_MESH_ID], device[CONF_NAME])
 
         lights.append(light)
 
-    async_add_entities(lights)
-
-def convert_value_to_available_range(value, min_from, max_from, min_to, max_to) -> int:
-    normalized = (value - min_from) / (max_from - min_from)
-    new_value = min(
-        round((normalized * (max_to - min_to)) + min_to),
-        max_to,
-    )
-    return max(new_value, min_to)
-
-
-def normal_round(n):
-    if n - math.floor(n) < 0.5:
-        return math.floor(n)
-    return math.ceil(n)
-
-
-def clamp(value, min_value, max_value):
-    return max(min_value, min(max_value, value))
-
+    # Mesh groups get a single light entity that sends one packet to the group address
+    group_lights = {}
 
-def saturate(value):
-    return clamp(value, 0.0, 1.0)
+    @callback
+    def _async_groups_changed(groups: list) -> list:
+        """Add, update and remove the group lights, returns the new ones"""
+        groups = list(groups)
+        if light_types:
+            groups.append({CONF_MESH_ID: MESH_ADDRESS_BROADCAST, CONF_NAME: 'All lights', CONF_MEMBERS: list(light_types)})
+        wanted = {}
+        for group in groups:
+            members = [member for member in group[CONF_MEMBERS] if member in light_types]
+            if members:
+                wanted[group[CONF_MESH_ID]] = (group[CONF_NAME], members)
+
+        registry = er.async_get(hass)
+        for mesh_id in [mesh_id for mesh_id in group_lights if mesh_id not in wanted]:
+            light = group_lights.pop(mesh_id)
+            _LOGGER.info('Remove group light [%d] %s', mesh_id, light.name)
+            # Removing the registry entry also removes the entity
+            if light.entity_id is not None and registry.async_get(light.entity_id) is not None:
+                registry.async_remove(light.entity_id)
+
+        new_lights = []
+        for mesh_id, (name, members) in wanted.items():
+            type_string = ' '.join(light_types[member] for member in members)
+            light = group_lights.get(mesh_id)
+            if light is None:
+                light = group_lights[mesh_id] = ZenggeGroupLight(mesh, mesh_id, name, members, supported_color_modes_for(type_string))
+                new_lights.append(light)
+                _LOGGER.info('Setup group light [%d] %s', mesh_id, name)
+            else:
+                light.async_set_members(name, members, supported_color_modes_for(type_string))
+        return new_lights
 
+    @callback
+    def _async_groups_updated(groups: list) -> None:
+        new_lights = _async_groups_changed(groups)
+        if new_lights:
+            async_add_entities(new_lights)
 
-def hue_to_rgb(h):
-    r = abs(h * 6.0 - 3.0) - 1.0
-    g = 2.0 - abs(h * 6.0 - 2.0)
-    b = 2.0 - abs(h * 6.0 - 4.0)
-    return saturate(r), saturate(g), saturate(b)
+    lights.extend(_async_groups_changed(entry.data.get(CONF_GROUPS, [])))
+    entry.async_on_unload(async_dispatcher_connect(hass, SIGNAL_GROUPS_UPDATED.format(entry.entry_id), _async_groups_updated))
 
+    async_add_entities(lights)
 
-def hsl_to_rgb(h, s=1, l=.5):
-    h = (h/360)
-    r, g, b = hue_to_rgb(h)
-    c = (1.0 - abs(2.0 * l - 1.0)) * s
-    r = round((r - 0.5) * c + l,4) * 255
-    g = round((g - 0.5) * c + l,4) * 255
-    b = round((b - 0.5) * c + l,4) * 255
-    if (r >= 250):
-        r = 255
-    if (g >= 250):
-        g = 255
-    if (b >= 250):
-        b = 255
-    return round(r), round(g), round(b)
+def supported_color_modes_for(type_string: str) -> set[ColorMode]:
+    supported_color_modes = set()
 
+    if 'color' in type_string:
+        supported_color_modes.add(ColorMode.RGB)
 
-def h360_to_h255(h360):
-    if h360 <= 180:
-        return normal_round((h360*254)/360)
-    else:
-        return normal_round((h360*255)/360)
+    if 'temperature' in type_string:
+        supported_color_modes.add(ColorMode.COLOR_TEMP)
 
+    if 'dimming' in type_string:
+        supported_color_modes.add(ColorMode.BRIGHTNESS)
 
-def h255_to_h360(h255):
-    if h255 <= 128:
-        return normal_round((h255*360)/254)
-    else:
-        return normal_round((h255*360)/255)
+    if len(supported_color_modes) == 0:
+        supported_color_modes.add(ColorMode.ONOFF)
 
+    # Home Assistant does not allow BRIGHTNESS next to a color mode, RGB and COLOR_TEMP dim as well
+    return filter_supported_color_modes(supported_color_modes)
 
 class ZenggeLight(CoordinatorEntity, LightEntity):
     """Representation of an Awesome Light."""
@@ -158,7 +154,7 @@ class ZenggeLight(CoordinatorEntity, LightEntity):
         self._model = model
         self._firmware = firmware
 
-        self._mesh.register_device(mesh_id, mac, name, self.status_callback)
+        self._register()
 
         self._state = None
         self._color_mode = False
@@ -169,6 +165,17 @@ class ZenggeLight(CoordinatorEntity, LightEntity):
         self._white_brightness = None
         self._color_brightness = None
 
+    def _register(self) -> None:
+        self._mesh.register_device(self._mesh_id, self._mac, self.name, self.status_callback)
+
+    async def async_added_to_hass(self) -> None:
+        await super().async_added_to_hass()
+        self.async_on_remove(lambda: self._mesh.async_forget_state_writes(self))
+        # Show the state from before the restart while the mesh connection comes up
+        status = self._mesh.restored_status(self._mesh_id)
+        if status is not None and self._state is None:
+            self._apply_device_status(status)
+
     @property
     def device_info(self) -> DeviceInfo:
         """Get device info."""
@@ -214,9 +221,7 @@ class ZenggeLight(CoordinatorEntity, LightEntity):
     @property
     def color_temp(self):
         """Return the color temperature in mired."""
-        if self._white_temperature is None:
-            return None
-        return convert_value_to_available_range(self._white_temperature, 0, 0x64, self.min_mireds, self.max_mireds)
+        return self._white_temperature
 
     @property
     def brightness(self):
@@ -233,73 +238,124 @@ class ZenggeLight(CoordinatorEntity, LightEntity):
 
     @property
     def min_mireds(self):
-        # 6500 Kelvin
-        return 153
+        return MIN_MIREDS
 
     @property
     def max_mireds(self):
-        # 2700 Kelvin
-        return 370
+        return MAX_MIREDS
 
     @property
     def is_on(self):
         """Return true if light is on."""
         return bool(self._state)
 
+    def _command_priority(self) -> int:
+        """Commands started by a user go before the ones started by automations"""
+        if self._context is not None and self._context.user_id is not None:
+            return PRIORITY_INTERACTIVE
+        return PRIORITY_AUTOMATION
+
     async def async_turn_on(self, **kwargs: Any) -> None:
         """Instruct the light to turn on."""
         status = {}
+        priority = self._command_priority()
 
         _LOGGER.info('[%s] Turn on %s', self.unique_id, kwargs)
 
-        if ATTR_RGB_COLOR in kwargs:
-            rgb = kwargs[ATTR_RGB_COLOR]
-            await self._mesh.async_set_color(self._mesh_id, rgb[0], rgb[1], rgb[2])
+        rgb = kwargs.get(ATTR_RGB_COLOR)
+        device_white_temp = None
+        device_brightness = None
+
+        if ATTR_COLOR_TEMP in kwargs:
+            device_white_temp = mired_to_cct(kwargs[ATTR_COLOR_TEMP])
+
+        if ATTR_BRIGHTNESS in kwargs:
+            device_brightness = brightness_to_device(kwargs[ATTR_BRIGHTNESS])
+        elif device_white_temp is not None:
+            # Temperature and luminance are set together, keep the last known luminance
+            # (of the color mode when switching from color), full only when none is known
+            last_brightness = self._white_brightness if self._white_brightness is not None else self._color_brightness
+            device_brightness = 0x64 if last_brightness is None else brightness_to_device(last_brightness)
+
+        sent_brightness = device_brightness
+        if (rgb is not None and device_brightness is not None and self.is_on and self.color_mode == ColorMode.RGB
+                and self._color_brightness is not None and device_brightness == brightness_to_device(self._color_brightness)):
+            # The color frame keeps the luminance, only a changed brightness needs its own frame
+            sent_brightness = None
+
+        # Color, brightness, temperature and power are combined in as few packets as possible
+        await self._mesh.async_set_state(self._mesh_id, rgb, sent_brightness, device_white_temp, priority=priority)
+        status['state'] = True
+
+        if rgb is not None:
             status['red'] = rgb[0]
             status['green'] = rgb[1]
             status['blue'] = rgb[2]
-            status['state'] = True
+            status['color_mode'] = 'rgb'
+        elif device_white_temp is not None:
+            status['white_temperature'] = device_white_temp
+            status['color_mode'] = 'white'
 
         if ATTR_BRIGHTNESS in kwargs:
-            status['state'] = True
-            if self.color_mode != ColorMode.RGB:
-                device_brightness = convert_value_to_available_range(kwargs[ATTR_BRIGHTNESS], 0, 255, int(1), int(0x64))
-                await self._mesh.async_set_white_brightness(self._mesh_id, device_brightness)
-                status['white_brightness'] = device_brightness
-            else:
-                device_brightness = convert_value_to_available_range(kwargs[ATTR_BRIGHTNESS], 0, 255, int(0x1), int(0x64))
-                await self._mesh.async_set_color_brightness(self._mesh_id, device_brightness)
+            if rgb is not None or (device_white_temp is None and self.color_mode == ColorMode.RGB):
                 status['color_brightness'] = device_brightness
-
-        if ATTR_COLOR_TEMP in kwargs:
-            device_white_temp = convert_value_to_available_range(kwargs[ATTR_COLOR_TEMP], self.min_mireds, self.max_mireds, 0, 0x64)
-            await self._mesh.async_set_white_temperature(self._mesh_id, device_white_temp)
-            status['state'] = True
-            status['white_temperature'] = device_white_temp
-
-        if 'state' not in status:
-            await self._mesh.async_on(self._mesh_id)
-            status['state'] = True
+            else:
+                status['white_brightness'] = device_brightness
+        elif rgb is None and device_white_temp is not None:
+            status['white_brightness'] = device_brightness
 
         self.status_callback(status)
 
     async def async_turn_off(self, **kwargs):
         """Instruct the light to turn off."""
         _LOGGER.info("[%s] turn off", self.unique_id)
-        await self._mesh.async_off(self._mesh_id)
+        await self._mesh.async_off(self._mesh_id, priority=self._command_priority())
         self.status_callback({'state': False})
 
+    def _color_mode_for(self, rgb: bool) -> ColorMode:
+        if rgb:
+            return ColorMode.RGB
+        if ColorMode.COLOR_TEMP in self.supported_color_modes:
+            return ColorMode.COLOR_TEMP
+        if ColorMode.BRIGHTNESS in self.supported_color_modes:
+            return ColorMode.BRIGHTNESS
+        if ColorMode.RGB in self.supported_color_modes:
+            return ColorMode.RGB
+        return ColorMode.ONOFF
+
+    def _apply_device_status(self, status: DeviceStatus) -> None:
+        self._state = status.state
+        if status.color_mode is None:
+            return
+        brightness = device_to_brightness(status.brightness)
+        if status.color_mode == 'rgb':
+            self._red = status.red
+            self._green = status.green
+            self._blue = status.blue
+            self._color_brightness = brightness
+        else:
+            self._white_temperature = cct_to_mired(status.white_temperature)
+            self._white_brightness = brightness
+        self._attr_color_mode = self._color_mode_for(status.color_mode == 'rgb')
+
     @callback
     def status_callback(self, status) -> None:
+        """Apply a DeviceStatus reported by the mesh, or a dict with a (partial) local state update"""
+        if isinstance(status, DeviceStatus):
+            self._apply_device_status(status)
+            _LOGGER.debug('[%s][%s] mode[%s] Status callback: %s', self.unique_id, self.name, self._attr_color_mode, status)
+            # Status sweeps report many devices at once, their state writes are batched
+            self._mesh.async_schedule_state_write(self)
+            return
 
         if 'state' in status:
             self._state = status['state']
         if 'white_brightness' in status:
-            self._white_brightness = convert_value_to_available_range(status['white_brightness'], 0, 100, 0, 255)
+            self._white_brightness = device_to_brightness(status['white_brightness'])
         if 'white_temperature' in status:
-            self._white_temperature = convert_value_to_available_range(status['white_temperature'], 0, 0x64, self.min_mireds, self.max_mireds)
+            self._white_temperature = cct_to_mired(status['white_temperature'])
         if 'color_brightness' in status:
-            self._color_brightness = convert_value_to_available_range(status['color_brightness'], 0, 100, 0, 255)
+            self._color_brightness = device_to_brightness(status['color_brightness'])
         if 'red' in status:
             self._red = status['red']
         if 'green' in status:
@@ -308,20 +364,85 @@ class ZenggeLight(CoordinatorEntity, LightEntity):
             self._blue = status['blue']
 
         if 'color_mode' in status:
-            supported_color_modes = self.supported_color_modes
-            color_mode = ColorMode.ONOFF
-            if status['color_mode']:
-                color_mode = ColorMode.RGB
-            elif ColorMode.COLOR_TEMP in supported_color_modes:
-                color_mode = self._attr_color_mode = ColorMode.COLOR_TEMP
-            elif ColorMode.BRIGHTNESS in supported_color_modes:
-                color_mode = self._attr_color_mode = ColorMode.BRIGHTNESS
-            self._attr_color_mode = color_mode
+            self._attr_color_mode = self._color_mode_for(status['color_mode'] == 'rgb')
 
         _LOGGER.info('[%s][%s] mode[%s] Status callback: %s', self.unique_id, self.name, self._attr_color_mode, status)
 
-        self.async_write_ha_state()
+        # Local updates follow commands, they are not throttled
+        self._mesh.async_schedule_state_write(self, min_interval=0)
 
     @callback
     def _handle_coordinator_update(self) -> None:
-        """No action here, update is handled by status_callback"""
\ No newline at end of file
+        """No action here, update is handled by status_callback"""
+
+    async def async_update(self) -> None:
+        """Only ask this light for its status instead of refreshing the whole mesh"""
+        await self._mesh.async_query_status([self._mesh_id])
+
+
+class ZenggeGroupLight(ZenggeLight):
+    """A mesh group (or all lights), controlled with a single packet to the group address."""
+
+    def __init__(self, coordinator: ZenggeMesh, mesh_id: int, name: str, members: list[int], supported_color_modes: set[str]):
+        super().__init__(coordinator, None, mesh_id, name, supported_color_modes, 'Zengge', 'Mesh group', None)
+        self._attr_unique_id = "zenggemesh-group-%s" % mesh_id
+        self._attr_color_mode = self._color_mode_for(ColorMode.RGB in supported_color_modes)
+        # Broadcasts reach every light in the mesh, only show this one when asked for
+        self._attr_entity_registry_enabled_default = mesh_id != MESH_ADDRESS_BROADCAST
+        self._members = members
+        self._member_entity_ids = []
+        self._unsub_members = None
+
+    def _register(self) -> None:
+        """Groups do not report a status, their state follows the member lights"""
+
+    async def async_update(self) -> None:
+        await self._mesh.async_query_status(self._members)
+
+    async def async_added_to_hass(self) -> None:
+        await super().async_added_to_hass()
+        self._track_members()
+        self.async_on_remove(self._untrack_members)
+        self._update_from_members()
+
+    @callback
+    def async_set_members(self, name: str, members: list[int], supported_color_modes: set[str]) -> None:
+        """Apply changed group memberships, without removing the entity"""
+        if name == self._attr_name and members == self._members and supported_color_modes == self._attr_supported_color_modes:
+            return
+        self._attr_name = name
+        self._members = members
+        self._attr_supported_color_modes = supported_color_modes
+        if self.hass is None:
+            return
+        self._track_members()
+        self._update_from_members()
+        self._mesh.async_schedule_state_write(self, min_interval=0)
+
+    def _track_members(self) -> None:
+        self._untrack_members()
+        registry = er.async_get(self.hass)
+        self._member_entity_ids = [
+            entity_id
+            for entity_id in (registry.async_get_entity_id(LIGHT_DOMAIN, DOMAIN, "zenggemesh-%s" % member) for member in self._members)
+            if entity_id is not None
+        ]
+        self._unsub_members = async_track_state_change_event(self.hass, self._member_entity_ids, self._async_member_changed)
+
+    @callback
+    def _untrack_members(self) -> None:
+        if self._unsub_members is not None:
+            self._unsub_members()
+            self._unsub_members = None
+
+    @callback
+    def _async_member_changed(self, event: Event) -> None:
+        self._update_from_members()
+        # Members change together during status sweeps, write the group once
+        self._mesh.async_schedule_state_write(self, min_interval=0)
+
+    def _update_from_members(self) -> None:
+        """On when any available member is on, unavailable when no member is available"""
+        states = [self.hass.states.get(entity_id) for entity_id in self._member_entity_ids]
+        available = [state for state in states if state is not None and state.state != STATE_UNAVAILABLE]
+        self._state = any(state.state == STATE_ON for state in available) if available else None
@@ -0,0 +1,95 @@
+"""Ranking of mesh devices by advertised signal strength"""
+import heapq
+import itertools
+import time
+
+#: Weight of the newest advertisement in the smoothed RSSI
+RSSI_SMOOTHING = .3
+#: Devices not advertised for this many seconds are considered out of range
+RSSI_MAX_AGE = 900
+
+
+class RssiRanking:
+    """
+    Keeps addresses ordered by smoothed RSSI, updated one advertisement at a time.
+
+    Every update pushes a new heap entry and leaves the previous entry of the
+    address behind; outdated entries are skipped when reading and dropped when
+    the heap is rebuilt. The n best addresses are read without sorting all
+    addresses.
+    """
+
+    def __init__(self, max_age: float = RSSI_MAX_AGE):
+        """
+        Args :
+            max_age: Seconds after the last advertisement an address is no longer ranked
+        """
+        self._max_age = max_age
+        self._heap = []
+        self._entries = {}  # Current heap entry per address
+        self._last_seen = {}
+        self._order = itertools.count()
+
+    def update(self, address: str, rssi: int, now: float = None) -> float:
+        """
+        Args :
+            address: The advertised address
+            rssi: The RSSI of the advertisement
+
+        Returns :
+            The smoothed RSSI of the address
+        """
+        previous = self.rssi(address)
+        smoothed = rssi if previous is None else previous + RSSI_SMOOTHING * (rssi - previous)
+        entry = (-smoothed, next(self._order), address)
+        self._entries[address] = entry
+        self._last_seen[address] = time.monotonic() if now is None else now
+        heapq.heappush(self._heap, entry)
+        if len(self._heap) > 2 * len(self._entries) + 16:
+            self._heap = list(self._entries.values())
+            heapq.heapify(self._heap)
+        return smoothed
+
+    def discard(self, address: str):
+        """Forget the address until it is advertised again"""
+        self._entries.pop(address, None)
+        self._last_seen.pop(address, None)
+
+    def snapshot(self) -> dict:
+        """The smoothed RSSI per ranked address"""
+        return {address: -entry[0] for address, entry in self._entries.items()}
+
+    def restore(self, snapshot: dict, now: float = None):
+        """
+        Args :
+            snapshot: The smoothed RSSI per address, see snapshot. Restored addresses
+                count as just seen and age out as usual when they are not advertised.
+        """
+        for address, rssi in snapshot.items():
+            if address not in self._entries:
+                self.update(address, rssi, now)
+
+    def rssi(self, address: str):
+        """The smoothed RSSI of the address, or None when it is not ranked"""
+        entry = self._entries.get(address)
+        return None if entry is None else -entry[0]
+
+    def ranked(self, now: float = None):
+        """
+        Yields the addresses from best to worst RSSI, walking the heap instead
+        of sorting it. The ranking must not be updated while iterating.
+        """
+        if now is None:
+            now = time.monotonic()
+        heap = self._heap
+        if not heap:
+            return
+        pending = [(heap[0], 0)]
+        while pending:
+            entry, index = heapq.heappop(pending)
+            address = entry[2]
+            if self._entries.get(address) is entry and now - self._last_seen[address] < self._max_age:
+                yield address
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < len(heap):
+                    heapq.heappush(pending, (heap[child], child))
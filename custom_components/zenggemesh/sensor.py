@@ -20,6 +20,7 @@ from homeassistant.components.sensor import (
     SensorEntityDescription,
 )
 from homeassistant.helpers.entity import EntityCategory
+from homeassistant.const import UnitOfTime
 from .const import DOMAIN
 
 _LOGGER = logging.getLogger(__name__)
@@ -31,6 +32,22 @@ SENSOR_TYPES: tuple[SensorEntityDescription, ...] = (
         icon="mdi:bluetooth-audio",
         entity_category=EntityCategory.DIAGNOSTIC,
     ),
+    SensorEntityDescription(
+        key='gateways',
+        name="Zengge mesh gateways",
+        icon="mdi:bluetooth-connect",
+        entity_registry_enabled_default=False,
+        entity_category=EntityCategory.DIAGNOSTIC,
+    ),
+    SensorEntityDescription(
+        key='poll_interval',
+        name="Zengge mesh poll interval",
+        device_class=SensorDeviceClass.DURATION,
+        native_unit_of_measurement=UnitOfTime.SECONDS,
+        icon="mdi:timer-sync-outline",
+        entity_registry_enabled_default=False,
+        entity_category=EntityCategory.DIAGNOSTIC,
+    ),
     SensorEntityDescription(
         key='last_rssi_check',
         name="Zengge mesh last RSSI check",
@@ -2,12 +2,11 @@
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives import padding
 from cryptography.hazmat.backends import default_backend
-import binascii
-import requests
 import asyncio
+import binascii
 import hashlib
+import logging
 import urllib
-import json
 import uuid
 import time
 import aiohttp
@@ -15,15 +14,44 @@ import aiohttp
 MAGICHUE_COUNTRY_SERVERS = [{'nationName': 'Australian', 'nationCode': 'AU', 'serverApi': 'oameshcloud.magichue.net:8081/MeshClouds/', 'brokerApi': 'oa.meshbroker.magichue.net'}, {'nationName': 'Avalon', 'nationCode': 'AL', 'serverApi': 'ttmeshcloud.magichue.net:8081/MeshClouds/', 'brokerApi': 'tt.meshbroker.magichue.net'}, {'nationName': 'China', 'nationCode': 'CN', 'serverApi': 'cnmeshcloud.magichue.net:8081/MeshClouds/', 'brokerApi': 'cn.meshbroker.magichue.net'}, {'nationName': 'England', 'nationCode': 'GB', 'serverApi': 'eumeshcloud.magichue.net:8081/MeshClouds/', 'brokerApi': 'eu.meshbroker.magichue.net'}, {'nationName': 'Espana', 'nationCode': 'ES', 'serverApi': 'eumeshcloud.magichue.net:8081/MeshClouds/', 'brokerApi': 'eu.meshbroker.magichue.net'}, {'nationName': 'France', 'nationCode': 'FR', 'serverApi': 'eumeshcloud.magichue.net:8081/MeshClouds/', 'brokerApi': 'eu.meshbroker.magichue.net'}, {'nationName': 'Germany', 'nationCode': 'DE', 'serverApi': 'eumeshcloud.magichue.net:8081/MeshClouds/', 'brokerApi': 'eu.meshbroker.magichue.net'}, {'nationName': 'Italy', 'nationCode': 'IT', 'serverApi': 'eumeshcloud.magichue.net:8081/MeshClouds/', 'brokerApi': 'eu.meshbroker.magichue.net'}, {'nationName': 'Japan', 'nationCode': 'JP', 'serverApi': 'dymeshcloud.magichue.net:8081/MeshClouds/', 'brokerApi': 'dy.meshbroker.magichue.net'}, {'nationName': 'Russia', 'nationCode': 'RU', 'serverApi': 'eumeshcloud.magichue.net:8081/MeshClouds/', 'brokerApi': 'eu.meshbroker.magichue.net'}, {'nationName': 'United States', 'nationCode': 'US', 'serverApi': 'usmeshcloud.magichue.net:8081/MeshClouds/', 'brokerApi': 'us.meshbroker.magichue.net'}]
 MAGICHUE_COUNTRY_SERVER = MAGICHUE_COUNTRY_SERVERS[10]['serverApi']
 MAGICHUE_CONNECTURL = "http://" + MAGICHUE_COUNTRY_SERVER
+# Regions share servers, every server is probed once
+MAGICHUE_SERVER_URLS = list(dict.fromkeys("http://" + server['serverApi'] for server in MAGICHUE_COUNTRY_SERVERS))
+#: Seconds a server gets to accept the login while probing
+MAGICHUE_PROBE_TIMEOUT = 10
 MAGICHUE_NATION_DATA_ENDPOINT = "apixp/MeshData/loadNationDataNew/ZG?language=en"
 MAGICHUE_USER_LOGIN_ENDPOINT = "apixp/User001/LoginForUser/ZG"
 MAGICHUE_GET_MESH_ENDPOINT = 'apixp/MeshData/GetMyMeshPlaceItems/ZG?userId='
 MAGICHUE_GET_MESH_DEVICES_ENDPOINT = 'apixp/MeshData/GetMyMeshDeviceItems/ZG?placeUniID=&userId='
 
+MAGICHUE_CHECKCODE_KEY = b"0FC154F9C01DFA9656524A0EFABC994F"
+MAGICHUE_HEADERS = {
+    'User-Agent': 'HaoDeng/1.5.7(ANDROID,10,en-US)',
+    'Accept-Language': 'en-US',
+    'Accept': 'application/json',
+    'token': '',
+    'Content-Type': 'application/json',
+    'Accept-Encoding': 'gzip'
+}
+
+# Only the encryptors are single use, the cipher is built once
+_CHECKCODE_CIPHER = Cipher(algorithms.AES(MAGICHUE_CHECKCODE_KEY), modes.ECB(), default_backend())
+
+_LOGGER = logging.getLogger(__name__)
+
 
 class ZenggeConnect:
 
-    def __init__(self, username: str, password: str, installation_id: str = None):
+    def __init__(self, session: aiohttp.ClientSession, username: str, password: str, installation_id: str = None,
+                 servers: list = None, server: str = None):
+        """
+        Args :
+            session: The HTTP session used for all requests, e.g. the shared session of Home Assistant
+            username: The username of the app account
+            password: The password of the app account
+            servers: Base URLs of the cloud servers to probe for the account, defaults to all regions
+            server: Base URL of the server chosen before, probing only happens when it rejects the login
+        """
+        self._session = session
         self._username = username
         self._password = password
         self._md5password = hashlib.md5(password.encode()).hexdigest()
@@ -31,97 +59,129 @@ class ZenggeConnect:
         self._user_id = None
         self._auth_token = None
         self._device_secret = None
-        self._mesh = None
+        self._headers = MAGICHUE_HEADERS
+        self._places = None
+        self._servers = MAGICHUE_SERVER_URLS if servers is None else servers
+        self._server = server
         self._installation_id = installation_id
 
         if not self._installation_id:
             self._installation_id = str(uuid.uuid4())
 
-        self.login()
-        self.credentials()
-
     def generate_timestampcheckcode(self):
-        SECRET_KEY = "0FC154F9C01DFA9656524A0EFABC994F"
         timestamp = str(int(time.time()*1000))
         value = ("ZG" + timestamp).encode()
-        backend = default_backend()
-        key = (SECRET_KEY).encode()
-        encryptor = Cipher(algorithms.AES(key), modes.ECB(), backend).encryptor()
-        padder = padding.PKCS7(algorithms.AES(key).block_size).padder()
+        encryptor = _CHECKCODE_CIPHER.encryptor()
+        padder = padding.PKCS7(algorithms.AES.block_size).padder()
         padded_data = padder.update(value) + padder.finalize()
         encrypted_text = encryptor.update(padded_data) + encryptor.finalize()
         checkcode = binascii.hexlify(encrypted_text).decode()
         return timestamp,checkcode
 
-    def login(self):
-        timestampcheckcode = self.generate_timestampcheckcode()
-        timestamp = timestampcheckcode[0]
-        checkcode = timestampcheckcode[1]
+    @property
+    def server(self):
+        """Base URL of the server that accepted the account, None before the login"""
+        return self._server
+
+    @server.setter
+    def server(self, server: str):
+        self._server = server
+
+    async def _request(self, method: str, endpoint: str, error: str, server: str = None, **kwargs):
+        server = server or self._server or MAGICHUE_CONNECTURL
+        async with self._session.request(method, server + endpoint, headers=self._headers, **kwargs) as response:
+            # The cloud does not always send a JSON content type
+            data = await response.json(content_type=None)
+            if response.status != 200:
+                raise Exception('%s - %s' % (error, data.get('error') if isinstance(data, dict) else response.status))
+            return data['result']
+
+    async def _login(self, server: str):
+        timestamp, checkcode = self.generate_timestampcheckcode()
         payload = dict(userID=self._username, password=self._md5password, appSys='Android', timestamp=timestamp, appVer='', checkcode=checkcode)
+        responseJSON = await asyncio.wait_for(
+            self._request('POST', MAGICHUE_USER_LOGIN_ENDPOINT, 'Login failed', server=server, json=payload),
+            MAGICHUE_PROBE_TIMEOUT
+        )
+        if not isinstance(responseJSON, dict) or 'auth_token' not in responseJSON:
+            raise Exception('Login failed - account unknown on %s' % server)
+        return responseJSON
+
+    async def _probe_servers(self):
+        """
+        Log in on all servers concurrently.
+
+        Returns :
+            (server, login result) of the fastest server that accepted the account
+        """
+        async def attempt(server):
+            return server, await self._login(server)
+
+        attempts = [asyncio.ensure_future(attempt(server)) for server in self._servers]
+        errors = []
+        try:
+            for next_attempt in asyncio.as_completed(attempts):
+                try:
+                    return await next_attempt
+                except Exception as e:
+                    errors.append(e)
+        finally:
+            for pending in attempts:
+                pending.cancel()
+            # No login request outlives the probe and the errors of the losing attempts are retrieved
+            await asyncio.gather(*attempts, return_exceptions=True)
+        raise errors[0] if errors else Exception('Login failed - no servers')
+
+    async def login(self):
+        self._headers = MAGICHUE_HEADERS
+        responseJSON = None
+        if self._server is not None:
+            try:
+                responseJSON = await self._login(self._server)
+            except Exception as e:
+                _LOGGER.info('Login on %s failed, probing all servers - [%s] %s', self._server, type(e).__name__, e)
+        if responseJSON is None:
+            self._server, responseJSON = await self._probe_servers()
+            _LOGGER.debug('Using cloud server %s', self._server)
 
-        headers = {
-            'User-Agent': 'HaoDeng/1.5.7(ANDROID,10,en-US)',
-            'Accept-Language': 'en-US',
-            'Accept': 'application/json',
-            'token': '',
-            'Content-Type': 'application/json',
-            'Accept-Encoding': 'gzip'
-        }
-
-        response = requests.post(MAGICHUE_CONNECTURL + MAGICHUE_USER_LOGIN_ENDPOINT, headers=headers, json=payload)
-
-        if response.status_code != 200:
-            raise Exception('Login failed - %s' % response.json()['error'])
-
-        responseJSON = response.json()['result']
         self._user_id = responseJSON['userId']
         self._auth_token = responseJSON['auth_token']
         self._device_secret = responseJSON['deviceSecret']
+        # Headers of all following requests, built once per session
+        self._headers = {**MAGICHUE_HEADERS, 'token': self._auth_token}
+
+    async def places(self) -> list:
+        """The places of the account, each with the credentials of its mesh"""
+        if self._places is not None:
+            return self._places
+        if self._auth_token is None or self._user_id is None:
+            await self.login()
+
+        self._places = await self._request('GET', MAGICHUE_GET_MESH_ENDPOINT + urllib.parse.quote_plus(self._user_id), 'Loading data failed')
+        return self._places
 
-    def credentials(self):
-        if self._mesh is not None:
-            return self._mesh
-        if self._auth_token is not None and self._user_id is not None:
-            headers = {
-                'User-Agent': 'HaoDeng/1.5.7(ANDROID,10,en-US)',
-                'Accept-Language': 'en-US',
-                'Accept': 'application/json',
-                'token': self._auth_token,
-                'Content-Type': 'application/json',
-                'Accept-Encoding': 'gzip'
-            }
-
-            response = requests.get(MAGICHUE_CONNECTURL + MAGICHUE_GET_MESH_ENDPOINT + urllib.parse.quote_plus(self._user_id), headers=headers)
-            if response.status_code != 200:
-                raise Exception('Loading data failed - %s' % response.json()['error'])
-            self._mesh = response.json()['result'][0]
-            return self._mesh
-        else:
-            raise Exception('No login session detected! - %s' % response.json()['error'])
+    async def credentials(self):
+        """The first place of the account"""
+        return (await self.places())[0]
 
     async def devices(self):
-        if self._auth_token is not None and self._user_id is not None:
-            headers = {
-                'User-Agent': 'HaoDeng/1.5.7(ANDROID,10,en-US)',
-                'Accept-Language': 'en-US',
-                'Accept': 'application/json',
-                'token': self._auth_token,
-                'Content-Type': 'application/json',
-                'Accept-Encoding': 'gzip'
-            }
-
-            placeUniID = self._mesh['placeUniID']
-            MAGICHUE_GET_MESH_DEVICES_ENDPOINTNEW = MAGICHUE_GET_MESH_DEVICES_ENDPOINT.replace("placeUniID=","placeUniID=" + placeUniID)
-            MAGICHUE_GET_MESH_DEVICES_ENDPOINTNEW = MAGICHUE_GET_MESH_DEVICES_ENDPOINTNEW.replace("userId=","userId="+urllib.parse.quote_plus(self._user_id))
-
-            #response = requests.get(MAGICHUE_CONNECTURL + MAGICHUE_GET_MESH_DEVICES_ENDPOINTNEW, headers=headers)
-            async with aiohttp.ClientSession() as session:
-                async with session.get(MAGICHUE_CONNECTURL + MAGICHUE_GET_MESH_DEVICES_ENDPOINTNEW, headers=headers) as response:
-                    if response.status != 200: #Previous code:   if response.status_code != 200:
-                        raise Exception('Device retrieval for mesh failed - %s' % response.json()['error'])
-                    else:
-                        responseJSON = (await response.json())['result'] #Previous Code:  responseJSON = response.json()['result'] #Previous Code:  
-                        self._mesh.update({'devices':responseJSON})
-                        return responseJSON
-        else:
-            raise Exception('No login session detected! - %s' % response.json()['error'])
\ No newline at end of file
+        """The devices of the first place of the account"""
+        return await self.place_devices(await self.credentials())
+
+    async def places_devices(self) -> list:
+        """
+        Returns :
+            The device list of every place, in the order of places(). The lists are
+            requested concurrently over the session.
+        """
+        places = await self.places()
+        return list(await asyncio.gather(*(self.place_devices(place) for place in places)))
+
+    async def place_devices(self, mesh: dict):
+        placeUniID = mesh['placeUniID']
+        MAGICHUE_GET_MESH_DEVICES_ENDPOINTNEW = MAGICHUE_GET_MESH_DEVICES_ENDPOINT.replace("placeUniID=","placeUniID=" + placeUniID)
+        MAGICHUE_GET_MESH_DEVICES_ENDPOINTNEW = MAGICHUE_GET_MESH_DEVICES_ENDPOINTNEW.replace("userId=","userId="+urllib.parse.quote_plus(self._user_id))
+
+        responseJSON = await self._request('GET', MAGICHUE_GET_MESH_DEVICES_ENDPOINTNEW, 'Device retrieval for mesh failed')
+        mesh.update({'devices':responseJSON})
+        return responseJSON
@@ -1,36 +1,82 @@
 """Zengge Mesh handler"""
 import logging
 import asyncio
+import time
 import async_timeout
 import homeassistant.util.dt as dt_util
 from datetime import timedelta
 from homeassistant.core import HomeAssistant, callback, CALLBACK_TYPE
 from homeassistant.const import EVENT_HOMEASSISTANT_STARTED, EVENT_HOMEASSISTANT_STOP
 from homeassistant.components import bluetooth
+from homeassistant.components.bluetooth import BluetoothChange, BluetoothScanningMode, BluetoothServiceInfoBleak
+from homeassistant.helpers.storage import Store
 from homeassistant.helpers.update_coordinator import DataUpdateCoordinator, UpdateFailed
+from homeassistant.util import slugify
 
 # import zenggemeshlight from .zenggemeshlight
-from .zenggemeshlight import ZenggeMeshLight
+from .zenggemeshlight import ZenggeMeshLight, DeviceStatus, PRIORITY_INTERACTIVE, PRIORITY_AUTOMATION, PRIORITY_BACKGROUND, MESH_ADDRESS_BROADCAST
 from .const import DOMAIN
+from .rssi_ranking import RssiRanking
+from .deadline_tracker import DeadlineTracker
 
 _LOGGER = logging.getLogger(__name__)
 
+#: Number of devices connected to in parallel when setting up the mesh connection,
+#: kept low as Bluetooth adapters and proxies only have a few connection slots
+CONNECT_RACE_SIZE = 3
+
+#: Devices that did not report their status for this many seconds are unavailable
+DEVICE_OFFLINE_TIMEOUT = 90
+
+#: Bounds and start value (seconds) of the adaptive update interval
+POLL_INTERVAL_MIN = 10
+POLL_INTERVAL_MAX = 60
+POLL_INTERVAL_DEFAULT = 30
+#: A device that did not report for this many seconds is asked for its status,
+#: well before it is considered offline
+STATUS_QUIET_AGE = 45
+#: Up to this many quiet devices are asked for their status one by one instead of asking the whole mesh
+TARGETED_QUERY_MAX = 3
+
+#: Bounds and start value (seconds) of the adaptive time devices get to answer a status request
+STATUS_WINDOW_MIN = .5
+STATUS_WINDOW_MAX = 5
+STATUS_WINDOW_DEFAULT = 2
+
+STORAGE_VERSION = 1
+#: Seconds changes are collected before the stored mesh state is written
+STORAGE_SAVE_DELAY = 30
+
+#: Assumed command latency (seconds) of a gateway until it has been measured
+GATEWAY_DEFAULT_LATENCY = .1
+#: Weight of the newest measurement in the smoothed latency of a gateway
+GATEWAY_LATENCY_WEIGHT = .2
+#: Latency (seconds) charged to a gateway after a failed command
+GATEWAY_FAILED_LATENCY = 5
+#: A gateway that did not hear from a device for this many seconds is not used to reach the device
+GATEWAY_REACH_TIMEOUT = 600
+#: Minimum seconds between two state writes of an entity caused by status reports, 0 only coalesces writes within a loop tick
+STATE_WRITE_MIN_INTERVAL = 0
+
 
 class ZenggeMesh(DataUpdateCoordinator):
 
-    def __init__(self, hass: HomeAssistant, mesh_name: str, mesh_password: str, mesh_long_term_key: str):
+    def __init__(self, hass: HomeAssistant, mesh_name: str, mesh_password: str, mesh_long_term_key: str,
+                 hot_standby: bool = False, gateways: int = 0):
         """
         Args :
             hass: HomeAssistance core
             mesh_name: The mesh name as a string
             mesh_password: The mesh password as a string
             mesh_long_term_key: The new long term key as a string
+            hot_standby: Keep a second connection to another device that takes over when the current connection drops
+            gateways: Number of extra connections, preferably through other Bluetooth adapters or proxies, that commands are spread over
         """
         super().__init__(
             hass,
             _LOGGER,
             name=DOMAIN,
-            update_interval=timedelta(seconds=30),
+            update_interval=timedelta(seconds=POLL_INTERVAL_DEFAULT),
         )
 
         self.hass = hass
@@ -39,16 +85,49 @@ class ZenggeMesh(DataUpdateCoordinator):
         self._mesh_long_term_key = mesh_long_term_key
 
         self._connected_bluetooth_device: ZenggeMeshLight = None
-        self._scanning_devices = False
+        # Extra logged in connections, they take over when the current connection drops
+        # and, when sharding is enabled, share the commands
+        self._gateways = {}
+        self._gateway_count = max(gateways, 1 if hot_standby else 0)
+        self._shard_commands = gateways > 0
+        self._gateways_connecting = False
+        self._gateway_latency = {}  # Smoothed command latency per connection
+        self._reach = {}  # Per mesh id, when each connection last heard from the device
+        self._gateway_sweeps = 0
+        # Per mesh id, [connection, commands queued or in flight] while commands are pending
+        self._pinned = {}
+        # Devices ranked by advertised RSSI, kept up to date by the Bluetooth integration
+        self._ranking = RssiRanking()
+        self._mesh_ids_by_address = {}
+        self._advertisement_unsubscribers = []
+
+        # Last connected device, ranking and light states from before a restart
+        self._store = Store(hass, STORAGE_VERSION, f'{DOMAIN}.{slugify(mesh_name)}')
+        self._last_gateway = None
+        self._restored_statuses = {}
+        self._connect_lock = asyncio.Lock()
 
         self.last_update_success = True
         self._state = {
             'last_rssi_check': None,
             'last_connection': None,
             'connected_device': None,
+            'gateways': 0,
+            'poll_interval': POLL_INTERVAL_DEFAULT,
         }
 
         self._devices = {}
+        self._groups = {}
+        self._status_collectors = []
+        self._status_window = STATUS_WINDOW_DEFAULT
+        self._last_sweep = None
+        # Fires when a device did not report its status in time
+        self._offline_tracker = DeadlineTracker(hass.loop, DEVICE_OFFLINE_TIMEOUT, self._device_offline)
+        # Entities waiting for their state write, with the loop time they may be written
+        self._dirty_entities = {}
+        self._last_state_write = {}
+        self._state_write_handle = None
+        self._state_write_at = None
 
         #self._queue = queue.Queue()
         self._shutdown = False
@@ -60,22 +139,29 @@ class ZenggeMesh(DataUpdateCoordinator):
         self._startup = False
         async def startup(event):
             _LOGGER.debug('startup')
+            self._unsub_startup = None
             self._startup = True
-            await self._async_get_devices_rssi()
             #asyncio.run_coroutine_threadsafe(
             #    self.async_refresh(), hass.loop
             #).result()
 
         async def shutdown(event):
             _LOGGER.info('[%s] Shutdown mesh!!', self.mesh_name)
+            self._unsub_shutdown = None
             self._shutdown = True
+            self._unsubscribe_advertisements()
+            self._offline_tracker.cancel()
+            self._cancel_state_writes()
+            await self._store.async_save(self._data_to_store())
+            await self._disconnect_gateways()
             await self._disconnect_current_device()
             #asyncio.run_coroutine_threadsafe(
             #    self.async_shutdown(), hass.loop
             #).result()
 
-        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STARTED, startup)
-        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, shutdown)
+        # Removed in async_shutdown, a reloaded entry must not save the state of its old mesh at stop
+        self._unsub_startup = hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STARTED, startup)
+        self._unsub_shutdown = hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, shutdown)
 
 
     @property
@@ -90,19 +176,95 @@ class ZenggeMesh(DataUpdateCoordinator):
     def state(self):
         return self._state
 
+    @property
+    def device_mesh_ids(self) -> list:
+        return list(self._devices.keys())
+
     def register_device(self, mesh_id: int, mac: str, name: str, callback_func: CALLBACK_TYPE):
+        # Entries from before the cloud inventory hold lowercase addresses
+        mac = mac.upper() if mac else mac
         self._devices[mesh_id] = {
             'mac': mac,
             'name': name,
             'callback': callback_func,
+            'last_status': None,
             'last_update': None,
             'update_count': 0,
             'status_request_count': 0,
             'rssi': -999999
         }
 
+        if mac:
+            address = mac
+            self._mesh_ids_by_address[address] = mesh_id
+            self._advertisement_unsubscribers.append(bluetooth.async_register_callback(
+                self.hass, self._async_advertisement, {'address': address, 'connectable': True}, BluetoothScanningMode.PASSIVE
+            ))
+
         _LOGGER.info('[%s] Registered [%s] %d', self.mesh_name, mac, mesh_id)
 
+    async def async_load(self):
+        """Restore the state stored before the last restart"""
+        data = await self._store.async_load()
+        if not data:
+            return
+        self._last_gateway = data.get('gateway')
+        self._ranking.restore(data.get('ranking', {}))
+        self._restored_statuses = {int(mesh_id): DeviceStatus(*status) for mesh_id, status in data.get('statuses', {}).items()}
+        _LOGGER.info('[%s] Restored %d light states, last connected device %s', self.mesh_name, len(self._restored_statuses), self._last_gateway)
+
+    @callback
+    def _data_to_store(self) -> dict:
+        statuses = {mesh_id: list(status) for mesh_id, status in self._restored_statuses.items()}
+        for mesh_id, device_info in self._devices.items():
+            if device_info['last_status'] is not None:
+                statuses[mesh_id] = list(device_info['last_status'])
+        return {
+            'gateway': self._last_gateway,
+            'ranking': self._ranking.snapshot(),
+            'statuses': statuses,
+        }
+
+    def restored_status(self, mesh_id: int):
+        """
+        The last status reported by a light before the restart, until the light reports again.
+
+        Returns :
+            A DeviceStatus or None
+        """
+        status = self._restored_statuses.get(mesh_id)
+        if status is not None and mesh_id in self._devices and self._devices[mesh_id]['last_update'] is None:
+            # Treat it as the last update, so the light is marked unavailable when it does not report
+            self._devices[mesh_id]['last_update'] = dt_util.now()
+            self._offline_tracker.refresh(mesh_id)
+        return status
+
+    async def async_connect(self):
+        """Connect right away instead of waiting for the first update interval"""
+        await self._async_connect_device()
+        if self.is_connected():
+            await self.async_request_status()
+
+    @callback
+    def _async_advertisement(self, service_info: BluetoothServiceInfoBleak, change: BluetoothChange):
+        mesh_id = self._mesh_ids_by_address.get(service_info.address)
+        if mesh_id is None or service_info.rssi is None:
+            return
+        self._devices[mesh_id]['rssi'] = self._ranking.update(service_info.address, service_info.rssi)
+        self._state['last_rssi_check'] = dt_util.now()
+
+    def _unsubscribe_advertisements(self):
+        for unsubscribe in self._advertisement_unsubscribers:
+            unsubscribe()
+        self._advertisement_unsubscribers = []
+
+    def set_groups(self, groups: list):
+        """
+        Args :
+            groups: The known mesh groups, a list of dicts with the group address as 'mesh_id' and the member mesh ids as 'members'
+        """
+        self._groups = {group['mesh_id']: set(group['members']) for group in groups}
+
     def is_connected(self) -> bool:
         return self._connected_bluetooth_device and self._connected_bluetooth_device.is_connected
 
@@ -110,18 +272,21 @@ class ZenggeMesh(DataUpdateCoordinator):
         return self._connected_bluetooth_device and self._connected_bluetooth_device.reconnecting
 
     async def _async_update_data(self):
-        if self._state['last_rssi_check'] is None: #Run RSSI check if new integration (no restart required)
-            _LOGGER.info('zenggemesh async update data - RSSI Check')
-            await self._async_get_devices_rssi()
-            return
         _LOGGER.info('zenggemesh async update data...')
 
         if not self.is_connected():
             await self._async_connect_device()
 
         if not self.is_connected():
+            self._set_poll_interval(POLL_INTERVAL_DEFAULT)
             return False
         _LOGGER.info('zenggemesh async update data 2...')
+
+        for device in [device for device in self._gateways if not device.is_connected]:
+            self._forget_gateway(device)
+            self.hass.async_create_task(device.stop())
+        if len(self._gateways) < self._gateway_count and not self._gateways_connecting:
+            self.hass.async_create_task(self._async_connect_gateways())
         #if not self._command_tread.is_alive():
         #    raise UpdateFailed("Command tread died!")
 
@@ -132,17 +297,40 @@ class ZenggeMesh(DataUpdateCoordinator):
         #    async with async_timeout.timeout(10):
         #        await self._disconnect_current_device()
         #_LOGGER.info('zenggemesh async update data 3...')
-        if self._state['last_rssi_check'] is None:
-            try:
-                async with async_timeout.timeout(20):
-                    # Scan for devices and get try to determine there RSSI
-                    await self._async_get_devices_rssi()
-            except Exception as e:
-                _LOGGER.warning('[%s] Fetching RSSI failed - [%s] %s', self.mesh_name, type(e).__name__, e)
         _LOGGER.info('zenggemesh async update data 4...')
+        # Devices push their status on every change, only ask for it when some went quiet
+        quiet_in = self._seconds_until_quiet()
+        if quiet_in is not None and quiet_in > 0 and self._last_sweep is not None \
+                and self.hass.loop.time() - self._last_sweep < POLL_INTERVAL_MAX:
+            _LOGGER.debug('[%s] All devices reported recently, status request skipped', self.mesh_name)
+            self._set_poll_interval(quiet_in)
+            return self._state
+
+        # A few quiet devices are asked directly, so the rest of the mesh does not have to report
+        if quiet_in is not None and self._last_sweep is not None \
+                and self.hass.loop.time() - self._last_sweep < POLL_INTERVAL_MAX:
+            quiet = self._offline_tracker.due(self.hass.loop.time() + DEVICE_OFFLINE_TIMEOUT - STATUS_QUIET_AGE)
+            if len(quiet) <= TARGETED_QUERY_MAX:
+                replied = await self.async_query_status(quiet, priority=PRIORITY_BACKGROUND)
+                _LOGGER.debug('[%s] Quiet devices %s, replied: %s', self.mesh_name, quiet, replied)
+                if len(replied) == len(quiet):
+                    self._set_poll_interval(self._seconds_until_quiet() or POLL_INTERVAL_MIN)
+                    return self._state
+
+        self._last_sweep = self.hass.loop.time()
         try:
             async with async_timeout.timeout(20):
-                await self.async_request_status()
+                reported = await self.async_collect_statuses(request=self.async_request_status)
+                _LOGGER.debug('[%s] %d devices reported their status', self.mesh_name, len(reported))
+                if self._shard_commands and self._gateways:
+                    # Keeps track of the devices each gateway can reach. One gateway asks per sweep, in turns,
+                    # the others listen, so the mesh traffic does not grow with the number of gateways
+                    gateways = list(self._gateways)
+                    self._gateway_sweeps += 1
+                    try:
+                        await gateways[self._gateway_sweeps % len(gateways)].requestStatus()
+                    except Exception as e:
+                        _LOGGER.debug('[%s] Requesting status through gateway failed - [%s] %s', self.mesh_name, type(e).__name__, e)
                 self.last_update_success = True
         except Exception as e:
             _LOGGER.info('[%s] Requesting status failed - [%s] %s', self.mesh_name, type(e).__name__, e)
@@ -156,95 +344,332 @@ class ZenggeMesh(DataUpdateCoordinator):
 
             raise UpdateFailed('Reconnecting to BLE device' if self.is_reconnecting() else 'No device connected')
 
-        # Give mesh time to gather status updates
-        await asyncio.sleep(2)
-
-        for mesh_id, device_info in self._devices.items():
-
-            _LOGGER.info(f'[{self.mesh_name}][{device_info["name"]}] update count: {device_info["update_count"]}; request count: {device_info["status_request_count"]}; RSSI: {device_info["rssi"]}; last update: {device_info["last_update"]}')
-
-            # Force status update for specific mesh_id when no new update for the last 60 secs
-            if device_info['last_update'] is None \
-                    or device_info['last_update'] < dt_util.now() - timedelta(seconds=60):
-                _LOGGER.info('[%s][%s][%d] async_update: Device offline for 60+ secs', self.mesh_name, device_info['name'], mesh_id)
+        quiet_in = self._seconds_until_quiet()
+        self._set_poll_interval(POLL_INTERVAL_DEFAULT if quiet_in is None else quiet_in)
 
-                #self._devices[mesh_id]['status_request_count'] += 1
-                #async with async_timeout.timeout(20): #No need to do specific device check due to previous check hitting ALL devices
-                #    await self.async_request_status()
-                #    #await self._async_add_command_to_queue('requestStatus', {'dest': mesh_id, 'withResponse': True}, True)
+        return self._state
 
-                # Give mesh time to gather status updates
-                #await asyncio.sleep(.5)
+    def _seconds_until_quiet(self):
+        """Seconds until the online device that reported longest ago goes quiet, None when no device is online"""
+        deadline = self._offline_tracker.earliest()
+        if deadline is None:
+            return None
+        return deadline - (DEVICE_OFFLINE_TIMEOUT - STATUS_QUIET_AGE) - self.hass.loop.time()
 
-            # Disable devices we didn't get a response the last 90 seconds
-            if self._devices[mesh_id]['last_update'] is not None \
-                    and self._devices[mesh_id]['last_update'] < dt_util.now() - timedelta(seconds=90):
-                self._devices[mesh_id]['callback']({'state': None})
-                self._devices[mesh_id]['last_update'] = None
-                self._devices[mesh_id]['update_count'] = 0
-                # Device offline then we assume it's also out-of-range (device that's not always powered on for instance)
-                if self._devices[mesh_id]['rssi'] > -9999:
-                    self._devices[mesh_id]['rssi'] = -9999
+    def _set_poll_interval(self, seconds: float):
+        seconds = max(POLL_INTERVAL_MIN, min(seconds, POLL_INTERVAL_MAX))
+        self.update_interval = timedelta(seconds=seconds)
+        self._state['poll_interval'] = round(seconds)
 
-        return self._state
+    @callback
+    def _device_offline(self, mesh_id: int):
+        device_info = self._devices.get(mesh_id)
+        if device_info is None or device_info['last_update'] is None:
+            return
+        _LOGGER.info('[%s][%s][%d] No status for %d+ secs, device offline (update count: %d)',
+                     self.mesh_name, device_info['name'], mesh_id, DEVICE_OFFLINE_TIMEOUT, device_info['update_count'])
+        device_info['callback']({'state': None})
+        device_info['last_status'] = None
+        device_info['last_update'] = None
+        device_info['update_count'] = 0
+        # Device offline then we assume it's also out-of-range (device that's not always powered on for instance),
+        # until it is advertised again
+        if device_info['mac']:
+            self._ranking.discard(device_info['mac'].upper())
+            device_info['rssi'] = -9999
 
     def update_status_of_all_devices_to_disabled(self):
         _LOGGER.info("------***------All devices disabled------***------")
         for mesh_id, device_info in self._devices.items():
             if device_info['last_update'] is not None:
                 device_info['callback']({'state': None})
+                self._devices[mesh_id]['last_status'] = None
                 self._devices[mesh_id]['last_update'] = None
                 self._devices[mesh_id]['update_count'] = 0
-        self._state['last_rssi_check'] = None
+        self._offline_tracker.clear()
         self._state['connected_device'] = None
 
     async def _async_update_mesh_state(self):
         if not self.is_connected() and not self.is_reconnecting():
             self._state['connected_device'] = None
+        self._state['gateways'] = len(self._gateways) + (1 if self.is_connected() else 0)
 
         for update_callback, _ in list(self._listeners.values()):
             update_callback()
 
     @callback
-    def mesh_status_callback(self, status):
-        if 'mesh_id' not in status or status['mesh_id'] not in self._devices:
-            _LOGGER.info('[%s] Status feedback of unknown device - [%s]',
-                         self.mesh_name, status['mesh_id'] if 'mesh_id' in status else 'unknown')
+    def mesh_status_callback(self, status: DeviceStatus):
+        if status.mesh_id not in self._devices:
+            _LOGGER.debug('[%s] Status feedback of unknown device - [%s]', self.mesh_name, status.mesh_id)
+            return
+
+        device_info = self._devices[status.mesh_id]
+        _LOGGER.debug('[%s][%s][%d] mesh_status_callback(%s)', self.mesh_name, device_info['name'], status.mesh_id, status)
+
+        device_info['last_update'] = dt_util.now()
+        device_info['update_count'] += 1
+        self._offline_tracker.refresh(status.mesh_id)
+        for expected, reported, waiter in self._status_collectors:
+            if status.mesh_id in expected and status.mesh_id not in reported:
+                reported.add(status.mesh_id)
+                if len(reported) == len(expected) and not waiter.done():
+                    waiter.set_result(None)
+
+        # Most notifications repeat the known state, only pass on changes
+        if status == device_info['last_status']:
+            return
+        device_info['last_status'] = status
+        self._restored_statuses.pop(status.mesh_id, None)
+        device_info['callback'](status)
+        self._store.async_delay_save(self._data_to_store, STORAGE_SAVE_DELAY)
+
+    @callback
+    def async_schedule_state_write(self, entity, min_interval: float = None):
+        """
+        Write the state of the entity with the next flush instead of right away. Flushes happen
+        once per event loop tick, so a burst of status reports writes every entity only once,
+        with its latest state.
+
+        Args :
+            entity: The entity to write, must be added to Home Assistant
+            min_interval: Minimum seconds since the last write of the entity, defaults to
+                STATE_WRITE_MIN_INTERVAL. 0 writes with the next flush.
+        """
+        if min_interval is None:
+            min_interval = STATE_WRITE_MIN_INTERVAL
+        now = self.hass.loop.time()
+        last_write = self._last_state_write.get(entity)
+        due = now if last_write is None else max(now, last_write + min_interval)
+        pending = self._dirty_entities.get(entity)
+        if pending is not None and pending <= due:
             return
+        self._dirty_entities[entity] = due
+        self._schedule_state_writes(due)
+
+    @callback
+    def async_forget_state_writes(self, entity):
+        """Drop the pending and last state write of an entity that is removed"""
+        self._dirty_entities.pop(entity, None)
+        self._last_state_write.pop(entity, None)
+
+    def _schedule_state_writes(self, when: float):
+        if self._state_write_handle is not None:
+            if self._state_write_at <= when:
+                return
+            self._state_write_handle.cancel()
+        self._state_write_at = when
+        if when <= self.hass.loop.time():
+            self._state_write_handle = self.hass.loop.call_soon(self._flush_state_writes)
+        else:
+            self._state_write_handle = self.hass.loop.call_at(when, self._flush_state_writes)
+
+    @callback
+    def _flush_state_writes(self):
+        self._state_write_handle = None
+        self._state_write_at = None
+        now = self.hass.loop.time()
+        due = [entity for entity, when in self._dirty_entities.items() if when <= now]
+        for entity in due:
+            del self._dirty_entities[entity]
+            self._last_state_write[entity] = now
+            # Entity might be removed meanwhile
+            if entity.hass is not None:
+                entity.async_write_ha_state()
+        if self._dirty_entities:
+            self._schedule_state_writes(min(self._dirty_entities.values()))
+
+    def _cancel_state_writes(self):
+        if self._state_write_handle is not None:
+            self._state_write_handle.cancel()
+        self._state_write_handle = None
+        self._state_write_at = None
+        self._dirty_entities.clear()
+
+    async def async_collect_statuses(self, mesh_ids=None, timeout: float = None, request=None) -> set:
+        """
+        Wait until devices have reported their status.
+
+        Args :
+            mesh_ids: The mesh ids to wait for, default the devices that are online (all devices when none is)
+            timeout: Max seconds to wait, default a window adapted to how long earlier status requests took
+            request: Optional coroutine function sending the status request, called once collecting has started.
+                When it returns False the request was not sent and nothing is awaited.
+
+        Returns :
+            The mesh ids of mesh_ids that reported
+        """
+        if mesh_ids is None:
+            mesh_ids = [mesh_id for mesh_id, device_info in self._devices.items() if device_info['last_update'] is not None] or self._devices
+        expected = set(mesh_ids)
+        reported = set()
+        waiter = self.hass.loop.create_future()
+        collector = (expected, reported, waiter)
+        self._status_collectors.append(collector)
+        started = self.hass.loop.time()
+        try:
+            if request is not None and await request() is False:
+                _LOGGER.debug('[%s] Status request skipped, commands are queued', self.mesh_name)
+                return reported
+            if expected:
+                await asyncio.wait_for(waiter, self._status_window if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            if timeout is None:
+                self._status_window = min(self._status_window * 1.25, STATUS_WINDOW_MAX)
+            _LOGGER.debug('[%s] No status of %s within %.1f secs', self.mesh_name, expected - reported, self._status_window)
+        else:
+            if timeout is None and expected:
+                # Allow twice the time the complete sweep took, smoothed
+                window = 2 * (self.hass.loop.time() - started)
+                self._status_window = max(STATUS_WINDOW_MIN, min(.8 * self._status_window + .2 * window, STATUS_WINDOW_MAX))
+        finally:
+            self._status_collectors.remove(collector)
+        return reported
+
+    async def async_query_status(self, mesh_ids, timeout: float = 2, priority: int = PRIORITY_AUTOMATION) -> set:
+        """
+        Ask specific devices whether they are online, without the rest of the mesh reporting.
 
-        _LOGGER.info('[%s][%s][%d] mesh_status_callback(%s)',
-                      self.mesh_name, self._devices[status['mesh_id']]['name'], status['mesh_id'], status)
+        Args :
+            mesh_ids: The mesh ids of the devices to ask
+            timeout: Seconds to wait for each reply
+            priority: One of the PRIORITY_* classes, polling uses PRIORITY_BACKGROUND
+
+        Returns :
+            The mesh ids that replied
+        """
+        if not self.is_connected():
+            return set()
+        mesh_ids = list(mesh_ids)
+        results = await asyncio.gather(
+            *[self._gateway_for(mesh_id).getStatus(mesh_id, timeout, priority) for mesh_id in mesh_ids],
+            return_exceptions=True
+        )
+        replied = {mesh_id for mesh_id, result in zip(mesh_ids, results) if not isinstance(result, BaseException)}
+        for mesh_id in replied:
+            device_info = self._devices.get(mesh_id)
+            # The reply has no state, it only keeps a device with a known state online
+            if device_info is not None and device_info['last_update'] is not None:
+                device_info['last_update'] = dt_util.now()
+                self._offline_tracker.refresh(mesh_id)
+        return replied
+
+    def _invalidate_status(self, mesh_id: int):
+        """Forget the last reported state, so the next report is always passed on to the entity"""
+        if mesh_id == MESH_ADDRESS_BROADCAST:
+            members = self._devices.keys()
+        else:
+            members = self._groups.get(mesh_id, (mesh_id,))
+        for member in members:
+            if member in self._devices:
+                self._devices[member]['last_status'] = None
+
+    async def async_request_status(self) -> bool:
+        return await self._connected_bluetooth_device.requestStatus()
+
+    async def async_on(self, mesh_id: int, priority: int = PRIORITY_INTERACTIVE):
+        self._invalidate_status(mesh_id)
+        await self._async_send(mesh_id, lambda device: device.on(mesh_id, priority=priority))
 
-        #if status['type'] != 'status':
-        #    _LOGGER.info('[%s][%s][%d] skipping all non status callbacks',
-        #              self.mesh_name, self._devices[status['mesh_id']]['name'], status['mesh_id'])
-        #    return
+    async def async_off(self, mesh_id: int, _attempt: int = 0, priority: int = PRIORITY_INTERACTIVE):
+        self._invalidate_status(mesh_id)
+        await self._async_send(mesh_id, lambda device: device.off(mesh_id, priority=priority))
 
-        self._devices[status['mesh_id']]['callback'](status)
+    async def async_set_color(self, mesh_id: int, r: int, g: int, b: int, _attempt: int = 0, priority: int = PRIORITY_INTERACTIVE):
+        self._invalidate_status(mesh_id)
+        await self._async_send(mesh_id, lambda device: device.setColor(r,g,b,mesh_id, priority=priority))
 
-        self._devices[status['mesh_id']]['last_update'] = dt_util.now()
-        self._devices[status['mesh_id']]['update_count'] += 1
+    async def async_set_color_brightness(self, mesh_id: int, brightness: int, _attempt: int = 0, priority: int = PRIORITY_INTERACTIVE):
+        self._invalidate_status(mesh_id)
+        await self._async_send(mesh_id, lambda device: device.setColorBrightness(brightness,mesh_id, priority=priority))
 
-    async def async_request_status(self):
-        await self._connected_bluetooth_device.requestStatus()
+    async def async_set_white_temperature(self, mesh_id: int, white_temperature: int, _attempt: int = 0, priority: int = PRIORITY_INTERACTIVE):
+        self._invalidate_status(mesh_id)
+        await self._async_send(mesh_id, lambda device: device.setWhiteTemperature(white_temperature,mesh_id, priority=priority))
 
-    async def async_on(self, mesh_id: int):
-        await self._connected_bluetooth_device.on(mesh_id)
+    async def async_set_white_brightness(self, mesh_id: int, brightness: int, _attempt: int = 0, priority: int = PRIORITY_INTERACTIVE):
+        self._invalidate_status(mesh_id)
+        await self._async_send(mesh_id, lambda device: device.setWhiteBrightness(brightness,mesh_id, priority=priority))
 
-    async def async_off(self, mesh_id: int, _attempt: int = 0):
-        await self._connected_bluetooth_device.off(mesh_id)
+    async def async_set_state(self, mesh_id: int, rgb: tuple = None, brightness: int = None, white_temperature: int = None, priority: int = PRIORITY_INTERACTIVE):
+        """Turn on and set the given values with as few packets as possible"""
+        self._invalidate_status(mesh_id)
+        await self._async_send(mesh_id, lambda device: device.setState(rgb, brightness, white_temperature, mesh_id, priority=priority))
 
-    async def async_set_color(self, mesh_id: int, r: int, g: int, b: int, _attempt: int = 0):
-        await self._connected_bluetooth_device.setColor(r,g,b,mesh_id)
+    async def async_add_group(self, mesh_id: int, group: int):
+        await self._async_send(mesh_id, lambda device: device.addGroup(group, mesh_id))
 
-    async def async_set_color_brightness(self, mesh_id: int, brightness: int, _attempt: int = 0):
-        await self._connected_bluetooth_device.setColorBrightness(brightness,mesh_id)
+    async def async_remove_group(self, mesh_id: int, group: int):
+        await self._async_send(mesh_id, lambda device: device.removeGroup(group, mesh_id))
 
-    async def async_set_white_temperature(self, mesh_id: int, white_temperature: int, _attempt: int = 0):
-        await self._connected_bluetooth_device.setWhiteTemperature(white_temperature,mesh_id)
+    async def async_get_groups(self, mesh_id: int) -> list:
+        return await self._async_send(mesh_id, lambda device: device.getGroups(mesh_id))
 
-    async def async_set_white_brightness(self, mesh_id: int, brightness: int, _attempt: int = 0):
-        await self._connected_bluetooth_device.setWhiteBrightness(brightness,mesh_id)
+    def _gateway_for(self, mesh_id: int) -> ZenggeMeshLight:
+        """
+        Pick the connection a command for mesh_id is sent through: the one with the lowest expected
+        delay among the connections that recently heard from the device. Group and broadcast commands
+        are flooded through the whole mesh, so any connection can send them.
+
+        While commands for mesh_id are pending on a connection, later ones follow them on the same
+        connection, so they keep their order and can supersede each other.
+        """
+        primary = self._connected_bluetooth_device
+        if not self._shard_commands or not self._gateways:
+            return primary
+
+        pinned = self._pinned.get(mesh_id)
+        if pinned is not None and pinned[0].is_connected and (pinned[0] is primary or pinned[0] in self._gateways):
+            return pinned[0]
+
+        now = time.monotonic()
+        heard = self._reach.get(mesh_id, {})
+        best, best_delay = primary, None
+        for device in (primary, *self._gateways):
+            if not device.is_connected:
+                continue
+            if device is not primary and mesh_id in self._devices and now - heard.get(device, -GATEWAY_REACH_TIMEOUT) >= GATEWAY_REACH_TIMEOUT:
+                continue
+            delay = self._gateway_latency.get(device, GATEWAY_DEFAULT_LATENCY) * (device.queue_depth + 1)
+            if best_delay is None or delay < best_delay:
+                best, best_delay = device, delay
+        return best
+
+    async def _async_send(self, mesh_id: int, send):
+        """
+        Args :
+            send: Called with the connection to use, returns the awaitable that sends the command(s)
+        """
+        device = self._gateway_for(mesh_id)
+        pinned = self._pinned.get(mesh_id)
+        if pinned is None or pinned[0] is not device:
+            pinned = self._pinned[mesh_id] = [device, 0]
+        pinned[1] += 1
+        try:
+            return await self._async_send_via(device, send)
+        finally:
+            pinned[1] -= 1
+            # Idle, the next command may take another connection
+            if pinned[1] == 0 and self._pinned.get(mesh_id) is pinned:
+                del self._pinned[mesh_id]
+
+    async def _async_send_via(self, device: ZenggeMeshLight, send):
+        started = time.monotonic()
+        try:
+            result = await send(device)
+        except Exception as e:
+            primary = self._connected_bluetooth_device
+            if device is primary or primary is None:
+                raise
+            _LOGGER.info('[%s][%s] Command through gateway failed, sending through %s - [%s] %s',
+                         self.mesh_name, device.mac, primary.mac, type(e).__name__, e)
+            self._update_latency(device, GATEWAY_FAILED_LATENCY)
+            return await send(primary)
+        self._update_latency(device, time.monotonic() - started)
+        return result
+
+    def _update_latency(self, device: ZenggeMeshLight, latency: float):
+        previous = self._gateway_latency.get(device)
+        self._gateway_latency[device] = latency if previous is None else previous + GATEWAY_LATENCY_WEIGHT * (latency - previous)
 
     async def _disconnect_current_device(self):
         if not self._connected_bluetooth_device:
@@ -259,14 +684,33 @@ class ZenggeMesh(DataUpdateCoordinator):
 
         await self._async_update_mesh_state()
 
+    async def _disconnect_gateways(self):
+        for device in list(self._gateways):
+            self._forget_gateway(device)
+            try:
+                async with async_timeout.timeout(10):
+                    await device.disconnect()
+            except Exception as e:
+                _LOGGER.exception('[%s][%s] Failed to disconnect gateway [%s] %s', self.mesh_name, device.mac, type(e).__name__, e)
+
     async def async_shutdown(self):
         _LOGGER.info('[%s] Shutdown mesh', self.mesh_name)
         self._shutdown = True
+        for unsub in (self._unsub_startup, self._unsub_shutdown):
+            if unsub is not None:
+                unsub()
+        self._unsub_startup = None
+        self._unsub_shutdown = None
+        self._unsubscribe_advertisements()
+        self._offline_tracker.cancel()
+        self._cancel_state_writes()
+        await self._store.async_save(self._data_to_store())
+        await self._disconnect_gateways()
         return await self._disconnect_current_device()
     
     async def async_refresh(self):
         _LOGGER.info('[%s] ****ASYNC REFRESH****', self.mesh_name)
-        await self._async_get_devices_rssi()
+        await self._async_update_mesh_state()
 
     async def _async_add_command_to_queue(self, command: str, params, allow_to_fail: bool = False):
         _LOGGER.info('[%s] Queue command %s %s', self.mesh_name, command, params)
@@ -354,95 +798,192 @@ class ZenggeMesh(DataUpdateCoordinator):
         ).result()
 
     async def _async_connect_device(self):
+        # The update cycle and async_connect can both try to connect
+        async with self._connect_lock:
+            await self._async_connect_device_locked()
+
+    async def _async_connect_device_locked(self):
         _LOGGER.info('zenggemesh async connect device...')
         while self.is_reconnecting():
             await asyncio.sleep(.1)
         if self.is_connected():
             return
-        for mesh_id, device_info in self._getConnectableDevices():
-            if device_info['rssi'] <= -127:  #Anything equal to or below -127 is not in connection range
-                continue
-            while self.is_reconnecting():
-                await asyncio.sleep(.1)
-            if self.is_connected():
+
+        candidates = self._getConnectableDevices()
+        # The device connected to before the restart is known to work, try it first
+        candidates.sort(key=lambda candidate: candidate[1]['mac'].upper() != self._last_gateway)
+
+        # Race the best candidates, so one dead but advertised device doesn't delay the connection
+        for i in range(0, len(candidates), CONNECT_RACE_SIZE):
+            device, device_info = await self._async_race_connect(candidates[i:i + CONNECT_RACE_SIZE])
+            if device is not None:
+                old_device = self._connected_bluetooth_device
                 self._connected_bluetooth_device = device
+                if old_device is not None:
+                    # Fails the commands still queued on the lost connection and ends its writer task
+                    await old_device.stop()
                 self._state['connected_device'] = device_info['name']
                 self._state['last_connection'] = dt_util.now()
+                self._last_gateway = device.mac.upper()
+                self._store.async_delay_save(self._data_to_store, STORAGE_SAVE_DELAY)
                 await self._async_update_mesh_state()
                 _LOGGER.info("[%s][%s][%s] Connected", self.mesh_name, device_info['name'], device_info['mac'])
                 break
-            if device_info['mac'] is None:
-                continue
-            #ble_device = bluetooth.async_ble_device_from_address(self.hass, device_info['mac'])
-            device = ZenggeMeshLight(device_info['mac'], None, self._mesh_name, self._mesh_password, hass=self.hass, disconnect_callback=self.update_status_of_all_devices_to_disabled)
-            try:
-                _LOGGER.info("[%s][%s][%s] Trying to connect", self.mesh_name, device_info['name'], device_info['mac'])
-                async with async_timeout.timeout(30):
-                    if await device.connect():
-                        self._connected_bluetooth_device = device
-                        self._state['connected_device'] = device_info['name']
-                        self._state['last_connection'] = dt_util.now()
-                        await self._async_update_mesh_state()
-                        _LOGGER.info("[%s][%s][%s] Connected", self.mesh_name, device_info['name'], device_info['mac'])
-                        break
-                    else:
-                        _LOGGER.info("[%s][%s][%s] Could not connect", self.mesh_name, device_info['name'], device_info['mac'])
-            except Exception as e:
-                _LOGGER.info('[%s][%s][%s] Failed to connect, trying next device [%s] %s',
-                                  self.mesh_name, device_info['name'], device_info['mac'], type(e).__name__, e)
-
-            _LOGGER.info('[%s][%s][%s] Setting up Bluetooth connection failed, making sure Bluetooth device stops trying', self.mesh_name, device_info['name'], device_info['mac'])
-
-            await device.stop()
-
-        _LOGGER.info('zenggemesh async connect device 4...')
 
-        if self.is_connected():
-            self._connected_bluetooth_device.status_callback = self.mesh_status_callback
-        else:
-            # Force new RSSI check no device we could connect to
-            self._state['last_rssi_check'] = None
-            _LOGGER.info("[%s][%s][%s] Last RSSI Check set to None", self.mesh_name, device_info['name'], device_info['mac'])
+        if not self.is_connected():
+            _LOGGER.info("[%s] Could not connect to any of the %d advertised devices", self.mesh_name, len(candidates))
             await self._async_update_mesh_state()
 
-    def _getConnectableDevices(self):
-        # Sort devices by rssi and only return devices with a RSSI that could be in range
-        return filter(lambda device: device[1]['rssi'] > -9999, sorted(self._devices.items(), key=lambda t: t[1]['rssi'], reverse=True))
-
-    async def _async_get_devices_rssi(self):
-        device_available = False
-        if self._scanning_devices:
-            _LOGGER.info(f'[{self.mesh_name}] Already scanning for devices')
-            return
-
-        _LOGGER.info(f'[{self.mesh_name}] Search for Zengge devices to find closest (best RSSI value) device')
+    async def _async_race_connect(self, candidates, ble_devices: dict = None):
+        """
+        Connect to all candidates at the same time and keep the first one that is logged in with notifications enabled.
 
-        self._scanning_devices = True
+        Args :
+            ble_devices: Optional BLE device to connect through per MAC address, to use a specific adapter or proxy
 
-        devices = bluetooth.async_discovered_service_info(self.hass).mapping
-        _LOGGER.debug(f'[{self.mesh_name}] Scan result: {repr(devices.keys())}')
+        Returns :
+            (device, device_info) of the connected device or (None, None)
+        """
+        attempts = {}
+        for mesh_id, device_info in candidates:
+            ble_device = ble_devices.get(device_info['mac']) if ble_devices else None
+            device = ZenggeMeshLight(device_info['mac'], ble_device, self._mesh_name, self._mesh_password, hass=self.hass, disconnect_callback=self._device_disconnected)
+            device.status_callback = lambda status, device=device: self._gateway_status_callback(device, status)
+            attempts[self.hass.async_create_task(self._async_try_connect(device, device_info))] = (device, device_info)
+
+        winner = (None, None)
+        pending = set(attempts)
+        while pending and winner[0] is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if winner[0] is None and task.result():
+                    winner = attempts[task]
+
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        for device, device_info in attempts.values():
+            if device is not winner[0]:
+                _LOGGER.info('[%s][%s][%s] Making sure Bluetooth device stops trying', self.mesh_name, device_info['name'], device_info['mac'])
+                await device.stop()
+
+        return winner
+
+    async def _async_try_connect(self, device: ZenggeMeshLight, device_info) -> bool:
+        try:
+            _LOGGER.info("[%s][%s][%s] Trying to connect", self.mesh_name, device_info['name'], device_info['mac'])
+            async with async_timeout.timeout(30):
+                if await device.connect():
+                    return True
+            _LOGGER.info("[%s][%s][%s] Could not connect", self.mesh_name, device_info['name'], device_info['mac'])
+        except Exception as e:
+            _LOGGER.info('[%s][%s][%s] Failed to connect [%s] %s',
+                         self.mesh_name, device_info['name'], device_info['mac'], type(e).__name__, e)
+        return False
 
-        for mesh_id, device_info in self._devices.items():
-            if device_info['mac'].upper() in devices.keys() and devices.get(device_info['mac'].upper()).rssi is not None:
-                _LOGGER.info('[%s][%s][%s] Bluetooth scan returns RSSI value = %s', self.mesh_name, device_info['name'],
-                             device_info['mac'], devices.get(device_info['mac'].upper()).rssi)
-                self._devices[mesh_id]['rssi'] = devices.get(device_info['mac'].upper()).rssi
-                if self._devices[mesh_id]['rssi'] >= -127:
-                    device_available = True
+    @callback
+    def _gateway_status_callback(self, device: ZenggeMeshLight, status: DeviceStatus):
+        self._reach.setdefault(status.mesh_id, {})[device] = time.monotonic()
+        self.mesh_status_callback(status)
 
-            elif device_info['mac'].upper() in devices.keys():
-                _LOGGER.info('[%s][%s][%s] Bluetooth scan returns no RSSI value', self.mesh_name, device_info['name'], device_info['mac'])
-                self._devices[mesh_id]['rssi'] = -99999
+    @callback
+    def _device_disconnected(self, device: ZenggeMeshLight):
+        # Only losing a connection in use matters, not the ones closed after a connection race
+        if device in self._gateways:
+            _LOGGER.info('[%s][%s] Gateway connection lost', self.mesh_name, device.mac)
+            self._forget_gateway(device)
+            self.hass.async_create_task(self._async_update_mesh_state())
+        elif device is self._connected_bluetooth_device:
+            if not self._promote_gateway():
+                self.hass.async_create_task(device.stop())
+                self.update_status_of_all_devices_to_disabled()
 
-            else:
-                _LOGGER.info('[%s][%s][%s] Device NOT found during Bluetooth scan', self.mesh_name, device_info['name'], device_info['mac'])
-                self._devices[mesh_id]['rssi'] = -999999
+    def _forget_gateway(self, device: ZenggeMeshLight):
+        self._gateways.pop(device, None)
+        self._gateway_latency.pop(device, None)
+        for heard in self._reach.values():
+            heard.pop(device, None)
+
+    def _ble_device_through_new_source(self, mac: str, used_sources: set):
+        """The BLE device for mac through the adapter or proxy with the best RSSI that is not in use yet, or None"""
+        scanner_devices = [scanner_device for scanner_device in bluetooth.async_scanner_devices_by_address(self.hass, mac.upper(), connectable=True)
+                           if scanner_device.scanner.source not in used_sources]
+        if not scanner_devices:
+            return None
+        return max(scanner_devices, key=lambda scanner_device: scanner_device.advertisement.rssi).ble_device
+
+    async def _async_connect_gateways(self):
+        """Set up the extra connections, each one through another adapter or proxy when possible"""
+        self._gateways_connecting = True
+        try:
+            while len(self._gateways) < self._gateway_count and not self._shutdown and self.is_connected():
+                connections = [self._connected_bluetooth_device, *self._gateways]
+                used_macs = {device.mac for device in connections}
+                used_sources = {device.source for device in connections}
+
+                ble_devices = {}
+                candidates = []
+                for mesh_id, device_info in self._getConnectableDevices():
+                    if device_info['mac'] in used_macs:
+                        continue
+                    ble_device = self._ble_device_through_new_source(device_info['mac'], used_sources)
+                    if ble_device is not None:
+                        ble_devices[device_info['mac']] = ble_device
+                    candidates.append((mesh_id, device_info))
+                # Another radio path first, the same adapter again only when there is no other one
+                candidates.sort(key=lambda candidate: candidate[1]['mac'] not in ble_devices)
+
+                device = None
+                for i in range(0, len(candidates), CONNECT_RACE_SIZE):
+                    device, device_info = await self._async_race_connect(candidates[i:i + CONNECT_RACE_SIZE], ble_devices)
+                    if device is not None:
+                        break
+                if device is None:
+                    break
+                if self._shutdown or not self.is_connected():
+                    await device.stop()
+                    break
+                self._gateways[device] = device_info
+                _LOGGER.info("[%s][%s][%s] Gateway connected through %s", self.mesh_name, device_info['name'], device_info['mac'], device.source)
+                await self._async_update_mesh_state()
+        finally:
+            self._gateways_connecting = False
 
-        if device_available == True:
-            self._state['last_rssi_check'] = dt_util.now()
-        else:
-            self._state['last_rssi_check'] = None
-            _LOGGER.info(f'[{self.mesh_name}] No available devices found during RSSI scan')
-        await self._async_update_mesh_state()
+    @callback
+    def _promote_gateway(self) -> bool:
+        """Let the fastest extra connection take over from the lost connection"""
+        connected = [device for device in self._gateways if device.is_connected]
+        if not connected:
+            return False
+        device = min(connected, key=lambda device: self._gateway_latency.get(device, GATEWAY_DEFAULT_LATENCY))
+        device_info = self._gateways[device]
+        old_device = self._connected_bluetooth_device
+        self._forget_gateway(device)
+        self._forget_gateway(old_device)
+        self._connected_bluetooth_device = device
+        self._state['connected_device'] = device_info['name']
+        self._state['last_connection'] = dt_util.now()
+        self._last_gateway = device.mac.upper()
+        self._store.async_delay_save(self._data_to_store, STORAGE_SAVE_DELAY)
+        _LOGGER.info('[%s][%s] Connection lost, gateway %s took over', self.mesh_name, old_device.mac, device.mac)
+
+        self.hass.async_create_task(old_device.stop())
+        self.hass.async_create_task(self._async_update_mesh_state())
+        self.hass.async_create_task(self.async_request_status())
+        if not self._shutdown and not self._gateways_connecting:
+            self.hass.async_create_task(self._async_connect_gateways())
+        return True
 
-        self._scanning_devices = False
\ No newline at end of file
+    def _getConnectableDevices(self) -> list:
+        """The devices in connection range, best RSSI first, as (mesh_id, device_info) tuples"""
+        candidates = []
+        for address in self._ranking.ranked():
+            # Anything equal to or below -127 is not in connection range, the rest ranks lower
+            if self._ranking.rssi(address) <= -127:
+                break
+            mesh_id = self._mesh_ids_by_address.get(address)
+            if mesh_id is None:  # Restored ranking of a removed device
+                continue
+            candidates.append((mesh_id, self._devices[mesh_id]))
+        return candidates
@@ -6,20 +6,28 @@ from bleak import BleakClient
 from homeassistant.components import bluetooth
 
 from . import packetutils as pckt
-from . import dimond_utils as dimond
+from .codec import MeshPacketCodec
+from .scheduler import CommandScheduler, SchedulerStopped, SupersededCommandFailed, PRIORITY_INTERACTIVE, PRIORITY_AUTOMATION, PRIORITY_BACKGROUND
+from .conversions import HUE_TO_RGB
 
 from os import urandom
 import asyncio
 import logging
 import struct
 import threading
-import math
+from collections import namedtuple
 
 # Commands :
 
 #: Set mesh groups.
-#: Data : 3 bytes
+#: Data : 3 bytes [Action (0x00 delete, 0x01 add)][Group address low][Group address high]
 C_MESH_GROUP = 0xd7
+GROUP_ACTION_DELETE = 0x00
+GROUP_ACTION_ADD = 0x01
+
+#: Get mesh groups. Data : [relay count] [0x01]
+#: Reply (OPCODE_GROUP_RECEIVED) data : the low byte of each group address, 0xff for unused slots
+C_GET_GROUP = 0xdd
 
 #: Set the mesh id. The light will still answer to the 0 mesh id. Calling the
 #: command again replaces the previous mesh id.
@@ -67,10 +75,15 @@ OPCODE_SETSTATE = 0xd0
 OPCODE_SETBRIGHTNESS = 0xd0
 OPCODE_SETFLASH = 0xd2
 
-OPCODE_GET_STATUS = 0xda        #Request current light/device status
+OPCODE_GET_STATUS = 0xda        #Request current light/device status. Data : [0x10]
 OPCODE_STATUS_RECEIVED = 0xdb    #Response of light/device status request
 OPCODE_NOTIFICATION_RECEIVED = 0xdc  #State notification
 OPCODE_RESPONSE = 0xdc
+OPCODE_GROUP_RECEIVED = 0xd4    #Response of group request
+
+#: Group addresses are 0x8000 + group number, commands to 0xffff reach all devices
+MESH_GROUP_BASE = 0x8000
+MESH_ADDRESS_BROADCAST = 0xffff
 
 STATEACTION_POWER = 0x01
 STATEACTION_BRIGHTNESS = 0x02
@@ -102,64 +115,50 @@ MODEL_NBR_UUID = "0000{0:x}-0000-1000-8000-00805f9b34fb".format(0x2A24)
 
 logger = logging.getLogger(__name__)
 
+#: Mesh address of the Wi-Fi bridge, it only reports its connection state
+MESH_ADDRESS_BRIDGE = 255
+
+#: Light modes reported in notifications for which the value byte is a hue
+STATUS_MODES_RGB = (63, 42)
+
+#: Parsed device state from a notification. For the Wi-Fi bridge only
+#: mesh_id and state are set.
+DeviceStatus = namedtuple('DeviceStatus', ['mesh_id', 'state', 'color_mode', 'red', 'green', 'blue', 'white_temperature', 'brightness'])
+
+#: Each OPCODE_NOTIFICATION_RECEIVED frame holds 2 device slots of 5 bytes:
+#: [mesh address][connected][brightness][mode][hue or cct]
+_STATUS_SLOT = struct.Struct('5B')
+_STATUS_SLOT_OFFSETS = (10, 15)
+
 class ZenggeColor:
     def __new__():
         raise TypeError("This is a static class and cannot be initialized.")
-    
-    @staticmethod
-    def _normal_round(n):
-        if n - math.floor(n) < 0.5:
-            return math.floor(n)
-        return math.ceil(n)
-    
-    @staticmethod
-    def _clamp(value, min_value, max_value):
-        return max(min_value, min(max_value, value))
-    
-    @staticmethod
-    def _saturate(value):
-        return ZenggeColor._clamp(value, 0.0, 1.0)
-    
-    @staticmethod
-    def _hue_to_rgb(h):
-        r = abs(h * 6.0 - 3.0) - 1.0
-        g = 2.0 - abs(h * 6.0 - 2.0)
-        b = 2.0 - abs(h * 6.0 - 4.0)
-        return ZenggeColor._saturate(r), ZenggeColor._saturate(g), ZenggeColor._saturate(b)
-    
-    @staticmethod
-    def _hsl_to_rgb(h, s=1, l=.5):
-        h = (h/360)
-        r, g, b = ZenggeColor._hue_to_rgb(h)
-        c = (1.0 - abs(2.0 * l - 1.0)) * s
-        r = round((r - 0.5) * c + l,4) * 255
-        g = round((g - 0.5) * c + l,4) * 255
-        b = round((b - 0.5) * c + l,4) * 255
-        if (r >= 250):
-            r = 255
-        if (g >= 250):
-            g = 255
-        if (b >= 250):
-            b = 255
-        return round(r), round(g), round(b)
-    
-    @staticmethod
-    def _h360_to_h255(h360):
-        if h360 <= 180:
-            return ZenggeColor._normal_round((h360*254)/360)
-        else:
-            return ZenggeColor._normal_round((h360*255)/360)
-    
-    @staticmethod
-    def _h255_to_h360(h255):
-        if h255 <= 128:
-            return ZenggeColor._normal_round((h255*360)/254)
-        else:
-            return ZenggeColor._normal_round((h255*360)/255)
-    
+
     @staticmethod
     def decode(color):
-        return ZenggeColor._hsl_to_rgb(ZenggeColor._h255_to_h360(color))
+        """The RGB of a hue byte, see conversions.HUE_TO_RGB"""
+        return HUE_TO_RGB[color]
+
+def parse_notification(data):
+    """
+    Args :
+        data: A decrypted OPCODE_NOTIFICATION_RECEIVED packet.
+
+    Returns :
+        A generator with a DeviceStatus for each used slot in the packet.
+    """
+    unpack_from = _STATUS_SLOT.unpack_from
+    for offset in _STATUS_SLOT_OFFSETS:
+        mesh_address, connected, brightness, mode, value = unpack_from(data, offset)
+        if mesh_address == 0:
+            continue
+        if mesh_address == MESH_ADDRESS_BRIDGE:
+            yield DeviceStatus(mesh_address, connected != 0, None, None, None, None, None, None)
+        elif mode in STATUS_MODES_RGB:
+            red, green, blue = HUE_TO_RGB[value]
+            yield DeviceStatus(mesh_address, brightness != 0 if connected != 0 else None, 'rgb', red, green, blue, None, brightness)
+        else:
+            yield DeviceStatus(mesh_address, brightness != 0 if connected != 0 else None, 'white', 0, 0, 0, value, brightness)
 
 class ZenggeMeshLight:
     def __init__(self, mac, ble_device=None, mesh_name="ZenggeMesh", mesh_password="ZenggeTechnology", mesh_id=0x0211, hass=None, disconnect_callback=None):
@@ -169,24 +168,31 @@ class ZenggeMeshLight:
             mesh_name: The mesh name as a string.
             mesh_password: The mesh password as a string.
             mesh_id: The mesh id (address)
+            ble_device: Optional BLEDevice to connect through, to use a specific adapter or proxy. Looked up by MAC address when None.
+            disconnect_callback: Called with this object when the connection is lost.
         """
         self.mac = mac
         self.mesh_id = mesh_id
         self.hass = hass
         self._disconnect_callback = disconnect_callback
         self.ble_device = ble_device
+        self._ble_device_fixed = ble_device is not None
         self.client = None
         self.session_key = None
+        self.codec = None
         self.status_callback = None
+        self._replies = {}  #Futures waiting for a reply, by (opcode, mesh id)
 
         self._reconnecting = False
         self._notify_enabled = False
         self.reconnect_counter = 0
-        self.processing_command = False #Prevent multiple commands being sent at same time
 
         self.mesh_name = mesh_name
         self.mesh_password = mesh_password
 
+        # All GATT operations go through the scheduler, to prevent multiple commands being sent at same time
+        self._scheduler = CommandScheduler(f'{mesh_name}][{mac}')
+
         # Light status
         #self.white_brightness = 1
         #self.white_temperature = 1
@@ -214,54 +220,83 @@ class ZenggeMeshLight:
         session_random = urandom(8)
         message = pckt.make_pair_packet(self.mesh_name.encode(), self.mesh_password.encode(), session_random)
         logger.info(f'[{self.mesh_name}][{self.mac}] Send pair message {message}')
-        self.processing_command = True
-        pairReply = await self.client.write_gatt_char(PAIR_CHAR_UUID, bytes(message), True)
-        await asyncio.sleep(0.3)
-        reply = await self.client.read_gatt_char(PAIR_CHAR_UUID)
-        self.processing_command = False
+
+        async def pair():
+            await self.client.write_gatt_char(PAIR_CHAR_UUID, bytes(message), True)
+            await asyncio.sleep(0.3)
+            return await self.client.read_gatt_char(PAIR_CHAR_UUID)
+
+        reply = await self._scheduler.run(pair)
         logger.debug(f"[{self.mesh_name}][{self.mac}] Read {reply} from characteristic {PAIR_CHAR_UUID}")
 
-        self.session_key = pckt.make_session_key(self.mesh_name.encode(), self.mesh_password.encode(), session_random, reply[1:9])
         if reply[0] == 0xd:
             self.session_key = pckt.make_session_key(self.mesh_name.encode(), self.mesh_password.encode(), session_random, reply[1:9])
+            self.codec = MeshPacketCodec(self.session_key, self.mac)
         else:
             if reply[0] == 0xe:
                 logger.info(f'[{self.mesh_name}][{self.mac}] Device authentication error: known mesh credentials are not excepted by the device. Did you re-pair them to your Hao Deng app with a different account?')
             else:
                 logger.info(f'[{self.mesh_name}][{self.mac}] Unexpected pair value : {repr(reply)}')
-            self.disconnect()
+            await self.disconnect()
             return False
 
-    async def send_packet(self, command, data, dest=None, withResponse=True, attempt=0, uuid=COMMAND_CHAR_UUID):
+    async def send_packet(self, command, data, dest=None, withResponse=True, attempt=0, uuid=COMMAND_CHAR_UUID, attribute=None, priority=PRIORITY_INTERACTIVE):
         """
         Args:
             command: The command, as a number.
             data: The parameters for the command, as bytes.
             dest: The destination mesh id, as a number. If None, this lightbulb's
                 mesh id will be used.
+            attribute: Optional name of the light attribute the command sets. A
+                queued command for the same destination and attribute is
+                replaced by this one.
+            priority: One of the PRIORITY_* classes.
         """
-        while self.processing_command == True:
-            await asyncio.sleep(.1)
-        self.processing_command = True
-        assert (self.session_key)
         if dest == None: dest = self.mesh_id
-        # packet = pckt.make_command_packet(self.session_key, self.mac, dest, command, data)
-        packet = dimond.send_packet(self.sk, self.mac, dest, command, data)
+
+        async def write():
+            assert (self.codec)
+            # Encode when the connection is free, so sequence numbers follow the write order
+            packet = self.codec.encode_command(dest, command, data)
+            logger.debug('[%s][%s] Writing command %d data %s', self.mesh_name, self.mac, command, data.hex())
+            return await self.client.write_gatt_char(uuid, packet, withResponse)
+
         try:
-            print(f'[{self.mesh_name}][{self.mac}] Writing command {command} data {repr(data)}')
-            reply = await self.client.write_gatt_char(uuid, packet, withResponse)
-            self.processing_command = False
-            return reply
+            return await self._scheduler.run(write, None if attribute is None else (dest, attribute), priority)
+        except (SchedulerStopped, SupersededCommandFailed):
+            # Disconnected on purpose, the connection must not come back. A failed
+            # replacing command is retried by its own caller.
+            raise
         except Exception as err:
-            self.processing_command = False
-            print(f'[{self.mesh_name}][{self.mac}] Command failed, attempt: {attempt} - [{type(err).__name__}] {err}')
+            logger.info(f'[{self.mesh_name}][{self.mac}] Command failed, attempt: {attempt} - [{type(err).__name__}] {err}')
             if attempt < 2:
                 await self.connect()
-                return self.send_packet(command, data, dest, withResponse, attempt+1)
+                return await self.send_packet(command, data, dest, withResponse, attempt+1, uuid, attribute, priority)
             else:
                 self.session_key = None
+                self.codec = None
                 raise err
 
+    async def send_packets(self, commands, withResponse=True, priority=PRIORITY_INTERACTIVE, key=None):
+        """
+        Encrypts all commands at once and writes them back-to-back.
+
+        Args:
+            commands: A list of (command, data, dest) tuples. When dest is None
+                this lightbulb's mesh id will be used.
+            priority: One of the PRIORITY_* classes.
+            key: Optional hashable, a queued batch with the same key is
+                replaced by this one.
+        """
+        async def write():
+            assert (self.codec)
+            packets = self.codec.encode_commands([(self.mesh_id if dest is None else dest, command, data) for command, data, dest in commands])
+            logger.debug('[%s][%s] Writing %d commands', self.mesh_name, self.mac, len(packets))
+            for packet in packets:
+                await self.client.write_gatt_char(COMMAND_CHAR_UUID, packet, withResponse)
+
+        return await self._scheduler.run(write, key, priority)
+
     async def connect(self, mesh_name=None, mesh_password=None) -> bool:
         """
         Args :
@@ -275,7 +310,8 @@ class ZenggeMeshLight:
         assert len(self.mesh_password) <= 16, "mesh_password can hold max 16 bytes"
 
         logger.info("[%s][%s] attemping connection...", self.mesh_name, self.mac)
-        self.ble_device = bluetooth.async_ble_device_from_address(self.hass, self.mac)
+        if not self._ble_device_fixed:
+            self.ble_device = bluetooth.async_ble_device_from_address(self.hass, self.mac)
         if self.ble_device:
             self.client = BleakClient(self.ble_device, timeout=15, disconnected_callback=self._disconnectCallback)
             logger.info("**Connecting with BLEDevice**")
@@ -283,9 +319,11 @@ class ZenggeMeshLight:
             self.client = BleakClient(self.mac, timeout=15, disconnected_callback=self._disconnectCallback)
         
         await self.client.connect()
+        self._scheduler.start()
         
         logger.info("[%s][%s] connected! Logging into mesh...", self.mesh_name, self.mac)
-        await self.mesh_login()
+        if await self.mesh_login() is False:
+            return False
 
         logger.info(f'[{self.mesh_name}][{self.mac}] Enabling notifications on device')
         await self.enable_notify()
@@ -298,7 +336,8 @@ class ZenggeMeshLight:
 
     def _disconnectCallback(self, event):
         logger.info(f'[{self.mesh_name}][{self.mac}] Disconnected by backend...Will reconnect within 30 secs')
-        self._disconnect_callback()
+        if self._disconnect_callback:
+            self._disconnect_callback(self)
         #self.hass.async_create_task(self._auto_reconnect())
         #if self.session_key:
             #logger.info(f'[{self.mesh_name}][{self.mac}] Try to reconnect...')
@@ -309,6 +348,7 @@ class ZenggeMeshLight:
 
     async def _auto_reconnect(self):
         self.session_key = None
+        self.codec = None
         self.reconnect_counter = 0
         self._reconnecting = True
         while self.session_key is None and self.reconnect_counter < 3 and self._reconnecting:
@@ -387,119 +427,103 @@ class ZenggeMeshLight:
 
     def _handleNotification(self, cHandle, data):
 
-        if self.session_key is None:
+        if self.codec is None:
             logger.info(f'[{self.mesh_name}][{self.mac}] Device is disconnected, ignoring received notification [unable to decrypt without active session]')
             return
 
-        message = dimond.decrypt_packet(self.session_key, self.mac, data)
-        logger.info(f'[{self.mesh_name}][{self.mac}] Recevied Notification: {repr(list(message))}')
+        # Decrypted in place into a buffer owned by the codec, the parser must
+        # not keep a reference to the message after returning
+        message = self.codec.decode_notification_into(data)
         if message is None:
-            logger.info(f'[{self.mesh_name}][{self.mac}] Failed to decrypt package [key: {self.session_key}, data: {data}]')
+            logger.info(f'[{self.mesh_name}][{self.mac}] Ignoring notification with unexpected length [data: {data}]')
             return
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('[%s][%s] Received notification: %s', self.mesh_name, self.mac, message.hex())
 
         self._parseStatusResult(message)
 
     def _parseStatusResult(self, data):
-        command = struct.unpack('B', data[7:8])[0]
-        status = {}
-        if command == OPCODE_STATUS_RECEIVED: #This does not return any useful status info, only that the device is online
-            mesh_address = struct.unpack('B', data[3:4])[0]
-            print("[%s] OPCODE_STATUS_RECEIVED", mesh_address)
-        elif command == OPCODE_NOTIFICATION_RECEIVED:  #Each notification can include info for 2 devices
-            device_1_data = struct.unpack('BBBBB', data[10:15])
-            device_2_data = struct.unpack('BBBBB', data[15:20])
-            if (device_1_data[0] != 0):
-                mesh_address = device_1_data[0]
-                connected = device_1_data[1]
-                if mesh_address == 255: #Mesh Address of Wi-Fi Bridge
-                    status = {
-                        'type': 'status',
-                        'mesh_id': mesh_address,
-                        'state': connected != 0,
-                    }
-                else:
-                    brightness = device_1_data[2]
-                    mode = device_1_data[3]
-                    cct = color = device_1_data[4]
-                    if(mode == 63 or mode == 42):
-                        color_mode = 'rgb'
-                        rgb = ZenggeColor.decode(color) #Converts from 1 value(hue) to RGB
-                    else:
-                        color_mode = 'white'
-                        rgb = [0,0,0]
-                    status = {
-                        'type': 'status',
-                        'mesh_id': mesh_address,
-                        'state': brightness != 0 if connected != 0 else None,
-                        'color_mode': color_mode,
-                        'red': rgb[0],
-                        'green': rgb[1],
-                        'blue': rgb[2],
-                        'white_temperature': cct,
-                        'brightness': brightness,
-                    }
-                logger.info(f'[{self.mesh_name}][{self.mac}] Parsed response - status: {status}\n')
-                if status and self.status_callback:
+        command = data[7]
+        if command == OPCODE_NOTIFICATION_RECEIVED:  #Each notification can include info for 2 devices
+            for status in parse_notification(data):
+                logger.debug('[%s][%s] Parsed response - status: %s', self.mesh_name, self.mac, status)
+                if self.status_callback:
                     self.status_callback(status)
+            return
 
-            if (device_2_data[0] != 0):
-                mesh_address = device_2_data[0]
-                connected = device_2_data[1]
-                if mesh_address == 255: #Mesh Address of Wi-Fi Bridge
-                    status = {
-                        'type': 'status',
-                        'mesh_id': mesh_address,
-                        'state': connected != 0,
-                    }
-                else:
-                    brightness = device_2_data[2]
-                    mode = device_2_data[3]
-                    cct = color = device_2_data[4]
-                    if(mode == 63 or mode == 42):
-                        color_mode = 'rgb'
-                        rgb = ZenggeColor.decode(color) #Converts from 1 value(hue) to RGB
-                    else:
-                        color_mode = 'white'
-                        rgb = [0,0,0]
-                    status = {
-                        'type': 'notification',
-                        'mesh_id': mesh_address,
-                        'state': brightness != 0 if connected != 0 else None,
-                        'color_mode': color_mode,
-                        'red': rgb[0],
-                        'green': rgb[1],
-                        'blue': rgb[2],
-                        'white_temperature': cct,
-                        'brightness': brightness,
-                    }
-                logger.info(f'[{self.mesh_name}][{self.mac}] Parsed response - status: {status}\n')
-                if status and self.status_callback:
-                    self.status_callback(status)
+        reply = self._replies.get((command, data[3]))
+        if reply is not None and not reply.done():
+            reply.set_result(bytes(data[10:20]))
+        elif command == OPCODE_STATUS_RECEIVED: #This does not return any useful status info, only that the device is online
+            logger.debug('[%s][%s] OPCODE_STATUS_RECEIVED from %d', self.mesh_name, self.mac, data[3])
         else:
-            print(f'[{self.mesh_name}][{self.mac}] Unknown command [{command}]')
+            logger.debug('[%s][%s] Unknown command [%d]', self.mesh_name, self.mac, command)
+
+    async def _request(self, command, data, dest, reply_command, timeout=5, priority=PRIORITY_INTERACTIVE):
+        """
+        Sends a command and waits for the reply of the destination device.
+
+        Args :
+            reply_command: The command (opcode) of the expected reply.
+            timeout: Seconds to wait for the reply.
+
+        Returns :
+            The parameters of the reply, 10 bytes.
+        """
+        key = (reply_command, dest)
+        pending = self._replies.get(key)
+        if pending is not None and not pending.done():
+            # The same question is already asked, its reply answers both callers
+            return await asyncio.wait_for(asyncio.shield(pending), timeout)
+        reply = asyncio.get_running_loop().create_future()
+        self._replies[key] = reply
+        try:
+            await self.send_packet(command, data, dest, priority=priority)
+            return await asyncio.wait_for(reply, timeout)
+        finally:
+            if self._replies.get(key) is reply:
+                del self._replies[key]
+
+    async def getStatus(self, dest=None, timeout=2, priority=PRIORITY_AUTOMATION):
+        """
+        Asks one device for its status, the other devices in the mesh stay quiet.
+
+        Returns :
+            The parameters of the OPCODE_STATUS_RECEIVED reply, 10 bytes. Zengge
+            devices only confirm they are online with it.
+        """
+        if dest == None: dest = self.mesh_id
+        return await self._request(OPCODE_GET_STATUS, b'\x10', dest, OPCODE_STATUS_RECEIVED, timeout, priority)
+
+    async def requestStatus(self, priority=PRIORITY_BACKGROUND):
+        """
+        Asks all devices in the mesh to report their status. Background requests
+        are skipped while commands with a higher priority are queued.
 
-    async def requestStatus(self):
-        while self.processing_command == True:
-            await asyncio.sleep(.1)
-        self.processing_command = True
+        Returns :
+            True when the request was sent, False when it was skipped.
+        """
         logger.debug(f'[{self.mesh_name}][{self.mac}] requestStatus')
-        reply = await self.client.write_gatt_char(STATUS_CHAR_UUID, b'\x01', True) #Zengge can't use Status request to receive device details, need notification requests
-        self.processing_command = False
-        return reply
 
-    async def setColor(self, red, green, blue, dest=None):
+        async def write():
+            await self.client.write_gatt_char(STATUS_CHAR_UUID, b'\x01', True) #Zengge can't use Status request to receive device details, need notification requests
+            return True
+
+        return await self._scheduler.run(write, ('status', None), priority, drop_if_busy=priority == PRIORITY_BACKGROUND) is True
+
+    async def setColor(self, red, green, blue, dest=None, priority=PRIORITY_INTERACTIVE):
         """
         Args :
             red, green, blue: between 0 and 0xff
         """
-        return await self.send_packet(OPCODE_SETCOLOR, bytes([0xFF,COLORMODE_RGB,red,green,blue]), dest)
+        return await self.send_packet(OPCODE_SETCOLOR, bytes([0xFF,COLORMODE_RGB,red,green,blue]), dest, attribute='color', priority=priority)
 
-    async def setColorBrightness(self, brightness, dest=None):
+    async def setColorBrightness(self, brightness, dest=None, priority=PRIORITY_INTERACTIVE):
         """
         Args :
             brightness: a value between 0xa and 0x64 ...
         """
-        return await self.send_packet(OPCODE_SETSTATE, bytes([0xFF,STATEACTION_BRIGHTNESS,brightness,DIMMINGTARGET_AUTO]), dest)
+        return await self.send_packet(OPCODE_SETSTATE, bytes([0xFF,STATEACTION_BRIGHTNESS,brightness,DIMMINGTARGET_AUTO]), dest, attribute='brightness', priority=priority)
 
     def setSequenceColorDuration(self, duration, dest=None): ###NOT IMPLEMENTED###
         """
@@ -517,48 +541,126 @@ class ZenggeMeshLight:
         data = struct.pack("<I", duration)
         return False #return self.send_packet(C_SEQUENCE_FADE_DURATION, data, dest)
 
-    async def setWhiteBrightness(self, brightness, dest=None):
+    async def setWhiteBrightness(self, brightness, dest=None, priority=PRIORITY_INTERACTIVE):
         """
         Args :
             brightness: between 1 and 0x7f
         """
-        return await self.send_packet(OPCODE_SETSTATE, bytes([0xFF,STATEACTION_BRIGHTNESS,brightness,DIMMINGTARGET_AUTO]), dest)
+        return await self.send_packet(OPCODE_SETSTATE, bytes([0xFF,STATEACTION_BRIGHTNESS,brightness,DIMMINGTARGET_AUTO]), dest, attribute='brightness', priority=priority)
 
-    async def setWhiteTemperature(self, temp, dest=None):
+    async def setWhiteTemperature(self, temp, dest=None, priority=PRIORITY_INTERACTIVE):
         """
         Args :
             temp: between 0 and 0x64
         """
         #OPCODE_SETCOLOR  COLORMODE_CCT
-        return await self.send_packet(OPCODE_SETCOLOR, bytes([0xFF,COLORMODE_CCT,temp,self.white_brightness]), dest)
+        return await self.send_packet(OPCODE_SETCOLOR, bytes([0xFF,COLORMODE_CCT,temp,self.white_brightness]), dest, attribute='color', priority=priority)
 
-    async def setWhite(self, temp, brightness, dest=None):
+    async def setWhite(self, temp, brightness, dest=None, priority=PRIORITY_INTERACTIVE):
         """
         Args :
             temp: between 0 and 0x7f
             brightness: between 1 and 0x7f
         """
-        return await self.send_packet(OPCODE_SETCOLOR, bytes([0xFF,COLORMODE_CCT,255,self.white_brightness]), dest)
+        return await self.send_packet(OPCODE_SETCOLOR, bytes([0xFF,COLORMODE_CCT,255,self.white_brightness]), dest, priority=priority)
+
+    @staticmethod
+    def buildStateCommands(rgb=None, brightness=None, temp=None, dest=None):
+        """
+        Encodes a target state in the fewest commands the firmware supports.
+        All commands also turn the light on.
+
+        Args :
+            rgb: (red, green, blue) tuple with values between 0 and 0xff
+            brightness: between 1 and 0x64
+            temp: between 0 and 0x64, ignored when rgb is set
+
+        Returns :
+            A list of (command, data, dest) tuples for send_packets.
+        """
+        if rgb is not None:
+            commands = [(OPCODE_SETCOLOR, bytes([0xFF,COLORMODE_RGB,rgb[0],rgb[1],rgb[2]]), dest)]
+            if brightness is not None:
+                commands.append((OPCODE_SETSTATE, bytes([0xFF,STATEACTION_BRIGHTNESS,brightness,DIMMINGTARGET_AUTO]), dest))
+            return commands
+        if temp is not None:
+            # Color temperature and luminance fit in one frame
+            return [(OPCODE_SETCOLOR, bytes([0xFF,COLORMODE_CCT,temp,0x64 if brightness is None else brightness]), dest)]
+        if brightness is not None:
+            return [(OPCODE_SETSTATE, bytes([0xFF,STATEACTION_BRIGHTNESS,brightness,DIMMINGTARGET_AUTO]), dest)]
+        return [(OPCODE_SETSTATE, bytes([0xFF,STATEACTION_POWER,1]), dest)]
+
+    @staticmethod
+    def stateAttributes(rgb=None, brightness=None, temp=None) -> tuple:
+        """
+        Returns :
+            The light attributes set by buildStateCommands, as used for the coalescing keys of send_packet.
+        """
+        attributes = []
+        if rgb is not None or temp is not None:
+            attributes.append('color')
+        if brightness is not None:
+            attributes.append('brightness')
+        return tuple(attributes) or ('power',)
+
+    async def setState(self, rgb=None, brightness=None, temp=None, dest=None, priority=PRIORITY_INTERACTIVE):
+        """
+        Turns the light on and sets color, brightness and/or temperature in one
+        write, see buildStateCommands. A queued command is only replaced by one
+        that sets the same attributes, a single attribute shares its key with
+        the set* commands.
+        """
+        if dest == None: dest = self.mesh_id
+        commands = self.buildStateCommands(rgb, brightness, temp, dest)
+        attributes = self.stateAttributes(rgb, brightness, temp)
+        key = (dest, attributes[0]) if len(attributes) == 1 else (dest, attributes)
+        return await self.send_packets(commands, priority=priority, key=key)
 
-    async def on(self, dest=None):
+    async def on(self, dest=None, priority=PRIORITY_INTERACTIVE):
         """ Turns the light on.
         """
-        return await self.send_packet(OPCODE_SETSTATE, bytes([0xFF,STATEACTION_POWER,1]), dest)
+        return await self.send_packet(OPCODE_SETSTATE, bytes([0xFF,STATEACTION_POWER,1]), dest, attribute='power', priority=priority)
 
-    async def off(self, dest=None):
+    async def off(self, dest=None, priority=PRIORITY_INTERACTIVE):
         """ Turns the light off.
         """
-        return await self.send_packet(OPCODE_SETSTATE, bytes([0xFF,STATEACTION_POWER,0]), dest)
+        return await self.send_packet(OPCODE_SETSTATE, bytes([0xFF,STATEACTION_POWER,0]), dest, attribute='power', priority=priority)
+
+    async def addGroup(self, group, dest=None, priority=PRIORITY_INTERACTIVE):
+        """
+        Args :
+            group: The group address, MESH_GROUP_BASE + group number.
+        """
+        return await self.send_packet(C_MESH_GROUP, bytes([GROUP_ACTION_ADD, group & 0xff, group >> 8 & 0xff]), dest, priority=priority)
+
+    async def removeGroup(self, group, dest=None, priority=PRIORITY_INTERACTIVE):
+        """
+        Args :
+            group: The group address, MESH_GROUP_BASE + group number.
+        """
+        return await self.send_packet(C_MESH_GROUP, bytes([GROUP_ACTION_DELETE, group & 0xff, group >> 8 & 0xff]), dest, priority=priority)
+
+    async def getGroups(self, dest=None, timeout=5):
+        """
+        Returns :
+            The group addresses the device is a member of.
+        """
+        if dest == None: dest = self.mesh_id
+        reply = await self._request(C_GET_GROUP, bytes([0x0a, 0x01]), dest, OPCODE_GROUP_RECEIVED, timeout, PRIORITY_AUTOMATION)
+        return [MESH_GROUP_BASE | group for group in reply if group != 0xff]
 
     async def reconnect(self) -> bool:
         logger.debug(f'[{self.mesh_name}][{self.mac}] Reconnecting')
         self.session_key = None
+        self.codec = None
         return await self.connect()
 
     async def disconnect(self):
         logger.debug(f'[{self.mesh_name}][{self.mac}] Disconnecting')
         self.session_key = None
+        self.codec = None
         self._reconnecting = False
+        await self._scheduler.stop()
 
         try:
             await self.client.disconnect()
@@ -571,6 +673,8 @@ class ZenggeMeshLight:
 
         self._reconnecting = False
         self.session_key = None
+        self.codec = None
+        await self._scheduler.stop()
 
         try:
             await self.client.disconnect()
@@ -602,6 +706,22 @@ class ZenggeMeshLight:
     def is_connected(self) -> bool:
         return self.session_key is not None and self.client and self.client.is_connected and self._notify_enabled
 
+    @property
+    def source(self):
+        """The adapter or proxy the connection goes through, None when unknown"""
+        details = getattr(self.ble_device, 'details', None)
+        return details.get('source') if isinstance(details, dict) else None
+
     @property
     def reconnecting(self) -> bool:
-        return self._reconnecting
\ No newline at end of file
+        return self._reconnecting
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of commands waiting for the connection"""
+        return self._scheduler.depth
+
+    @property
+    def commands_superseded(self) -> int:
+        """Number of queued commands replaced by a newer value before being sent"""
+        return self._scheduler.superseded
\ No newline at end of file
@@ -0,0 +1,135 @@
+from Crypto.Cipher import AES
+from os import urandom
+
+class MeshPacketCodec:
+    """
+    Encrypts commands and decrypts notifications for one mesh session.
+
+    The mesh uses AES-128 ECB with the key, the input block and the output
+    block all byte-reversed. The reversed key and the cipher object are built
+    once per session instead of once per block, and packets are handled as
+    bytes/bytearray instead of lists.
+    """
+
+    def __init__(self, session_key, mac, vendor=0x0211):
+        """
+        Args :
+            session_key: The session key returned by the mesh login, 16 bytes.
+            mac: The MAC address of the connected light as a string.
+            vendor: The vendor id placed in every command, as a number.
+        """
+        assert len(session_key) == 16, 'Session key must be 16 bytes'
+        self._cipher = AES.new(bytes(session_key)[::-1], AES.MODE_ECB)
+        address = bytes.fromhex(mac.replace(':', ''))[::-1]
+        self._vendor = vendor.to_bytes(2, 'little')
+        # Static part of the command nonce, see encode_command
+        self._command_nonce = address[0:4] + b'\x01'
+        self._sequence = int.from_bytes(urandom(3), 'little')
+
+        # Buffers reused by decode_notification_into. The nonce block is kept
+        # byte-reversed so it can be fed to the cipher as-is.
+        self._rx = bytearray(20)
+        self._rx_view = memoryview(self._rx)
+        self._rx_nonce = bytearray(16)
+        self._rx_nonce[12:15] = address[2::-1]
+        self._rx_keystream = bytearray(16)
+
+    def _encrypt(self, data):
+        return self._cipher.encrypt(data[::-1])[::-1]
+
+    def _next_sequence(self):
+        self._sequence = (self._sequence + 1) & 0xffffff
+        return self._sequence.to_bytes(3, 'little')
+
+    def encode_command(self, dest, command, data):
+        """
+        Args :
+            dest: The mesh id of the command destination as a number.
+            command: The command (opcode) as a number.
+            data: The parameters for the command as bytes, max 10 bytes.
+
+        Returns :
+            The encrypted 20 bytes packet ready to be written to the command
+            characteristic.
+        """
+        return self.encode_commands([(dest, command, data)])[0]
+
+    def encode_commands(self, commands):
+        """
+        Encrypts several commands with two cipher calls in total: one for the
+        authenticator and keystream blocks of all packets and one for all
+        checksum blocks.
+
+        Args :
+            commands: An iterable of (dest, command, data) tuples, see encode_command.
+
+        Returns :
+            A list with the encrypted 20 bytes packets, in the same order.
+        """
+        packets = []
+        nonce_blocks = bytearray()
+        for dest, command, data in commands:
+            assert len(data) <= 10, 'Command data can hold max 10 bytes'
+            packet = bytearray(20)
+            sequence = self._next_sequence()
+            packet[0:3] = sequence
+            packet[5:7] = (dest & 0xffff).to_bytes(2, 'little')
+            packet[7] = command
+            packet[8:10] = self._vendor
+            packet[10:10 + len(data)] = data
+            packets.append(packet)
+
+            nonce = self._command_nonce + sequence
+            nonce_blocks += nonce + b'\x0f\x00\x00\x00\x00\x00\x00\x00'
+            nonce_blocks += b'\x00' + nonce + b'\x00\x00\x00\x00\x00\x00\x00'
+
+        if not packets:
+            return []
+
+        # Reversing the whole buffer keeps ECB block boundaries, so every
+        # block is encrypted exactly as a single block call would.
+        nonce_blocks = self._encrypt(nonce_blocks)
+
+        mac_blocks = bytearray()
+        for i, packet in enumerate(packets):
+            authenticator = nonce_blocks[i * 32:i * 32 + 16]
+            mac_blocks += _xor(authenticator[0:15], packet[5:20]) + authenticator[15:16]
+        mac_blocks = self._encrypt(mac_blocks)
+
+        for i, packet in enumerate(packets):
+            keystream = nonce_blocks[i * 32 + 16:i * 32 + 31]
+            packet[3:5] = mac_blocks[i * 16:i * 16 + 2]
+            packet[5:20] = _xor(packet[5:20], keystream)
+        return [bytes(packet) for packet in packets]
+
+    def decode_notification_into(self, packet):
+        """
+        Decrypts the payload part (byte 7 and up) of a notification into a
+        buffer owned by the codec instead of allocating a new packet.
+
+        Args :
+            packet: The 20 bytes packet received on the status characteristic.
+
+        Returns :
+            A memoryview on the decrypted packet, or None when the packet does
+            not have the expected length. The view is only valid until the next
+            call, copy it when it has to be kept.
+        """
+        if len(packet) != 20:
+            return None
+        rx = self._rx
+        nonce = self._rx_nonce
+        keystream = self._rx_keystream
+        rx[:] = packet
+        nonce[7] = rx[4]
+        nonce[8] = rx[3]
+        nonce[9] = rx[2]
+        nonce[10] = rx[1]
+        nonce[11] = rx[0]
+        self._cipher.encrypt(nonce, output=keystream)
+        for i in range(7, 20):
+            rx[i] ^= keystream[22 - i]
+        return self._rx_view
+
+def _xor(a, b):
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
@@ -0,0 +1,97 @@
+"""
+Conversions between Home Assistant light values and the values of the Zengge devices.
+
+All inputs are small integer ranges, so every conversion is computed once at import with
+the float functions below and afterwards only looked up in a table.
+"""
+import math
+
+#: Coolest white of the lights in mired (6500 Kelvin)
+MIN_MIREDS = 153
+#: Warmest white of the lights in mired (2700 Kelvin)
+MAX_MIREDS = 370
+
+
+def convert_value_to_available_range(value, min_from, max_from, min_to, max_to) -> int:
+    normalized = (value - min_from) / (max_from - min_from)
+    new_value = min(
+        round((normalized * (max_to - min_to)) + min_to),
+        max_to,
+    )
+    return max(new_value, min_to)
+
+
+def normal_round(n):
+    if n - math.floor(n) < 0.5:
+        return math.floor(n)
+    return math.ceil(n)
+
+
+def clamp(value, min_value, max_value):
+    return max(min_value, min(max_value, value))
+
+
+def saturate(value):
+    return clamp(value, 0.0, 1.0)
+
+
+def hue_to_rgb(h):
+    r = abs(h * 6.0 - 3.0) - 1.0
+    g = 2.0 - abs(h * 6.0 - 2.0)
+    b = 2.0 - abs(h * 6.0 - 4.0)
+    return saturate(r), saturate(g), saturate(b)
+
+
+def hsl_to_rgb(h, s=1, l=.5):
+    h = (h/360)
+    r, g, b = hue_to_rgb(h)
+    c = (1.0 - abs(2.0 * l - 1.0)) * s
+    r = round((r - 0.5) * c + l,4) * 255
+    g = round((g - 0.5) * c + l,4) * 255
+    b = round((b - 0.5) * c + l,4) * 255
+    if (r >= 250):
+        r = 255
+    if (g >= 250):
+        g = 255
+    if (b >= 250):
+        b = 255
+    return round(r), round(g), round(b)
+
+
+def h255_to_h360(h255):
+    if h255 <= 128:
+        return normal_round((h255*360)/254)
+    else:
+        return normal_round((h255*360)/255)
+
+
+#: HA brightness 0-255 to device brightness 1-100
+BRIGHTNESS_TO_DEVICE = tuple(convert_value_to_available_range(value, 0, 255, 1, 100) for value in range(256))
+#: Device brightness 0-100 to HA brightness 0-255
+DEVICE_TO_BRIGHTNESS = tuple(convert_value_to_available_range(value, 0, 100, 0, 255) for value in range(101))
+#: Mired MIN_MIREDS-MAX_MIREDS (offset by MIN_MIREDS) to device white temperature 0-100
+MIRED_TO_CCT = tuple(convert_value_to_available_range(value, MIN_MIREDS, MAX_MIREDS, 0, 100) for value in range(MIN_MIREDS, MAX_MIREDS + 1))
+#: Device white temperature 0-100 to mired
+CCT_TO_MIRED = tuple(convert_value_to_available_range(value, 0, 100, MIN_MIREDS, MAX_MIREDS) for value in range(101))
+#: Hue byte (as reported in notifications) to RGB
+HUE_TO_RGB = tuple(hsl_to_rgb(h255_to_h360(value)) for value in range(256))
+
+
+def _index(value, min_value, max_value) -> int:
+    return min(max(round(value), min_value), max_value)
+
+
+def brightness_to_device(brightness) -> int:
+    return BRIGHTNESS_TO_DEVICE[_index(brightness, 0, 255)]
+
+
+def device_to_brightness(value) -> int:
+    return DEVICE_TO_BRIGHTNESS[_index(value, 0, 100)]
+
+
+def mired_to_cct(mired) -> int:
+    return MIRED_TO_CCT[_index(mired, MIN_MIREDS, MAX_MIREDS) - MIN_MIREDS]
+
+
+def cct_to_mired(value) -> int:
+    return CCT_TO_MIRED[_index(value, 0, 100)]
@@ -21,32 +21,43 @@ def make_checksum (key, nonce, payload):
         nonce:
         payload: The unencrypted payload.
     """
+    # Every block is chained on the previous one, so only the cipher setup
+    # can be shared between the blocks.
+    cipher = AES.new(bytes(key)[::-1], AES.MODE_ECB)
     base = nonce + bytearray ([len(payload)])
-    base = base.ljust (16, b'\x00')
-    check = encrypt (key, base)
+    check = cipher.encrypt (bytes(base.ljust (16, b'\x00'))[::-1])[::-1]
 
     for i in range (0, len (payload), 16):
-        check_payload = bytearray (payload[i:i+16].ljust (16, b'\x00'))
-        check = bytearray([ a ^ b for (a,b) in zip(check, check_payload) ])
-        check = encrypt (key, check)
+        check_payload = bytes (payload[i:i+16]).ljust (16, b'\x00')
+        check = bytes([ a ^ b for (a,b) in zip(check, check_payload) ])
+        check = cipher.encrypt (check[::-1])[::-1]
 
-    return check
+    return bytearray (check)
 
 def crypt_payload (key, nonce, payload):
     """
     Used for both encrypting and decrypting.
 
     """
-    base = bytearray(b'\x00' + nonce)
-    base = base.ljust (16, b'\x00')
-    result = bytearray ()
+    # The counter blocks do not depend on each other, encrypt them in one call
+    blocks = bytearray ()
+    for counter in range (0, (len (payload) + 15) // 16):
+        blocks += bytearray([counter & 0xff]) + bytes(nonce).ljust (15, b'\x00')
+    if not blocks:
+        return bytearray ()
+    keystream = encrypt_blocks (key, blocks)
 
-    for i in range (0, len (payload), 16):
-        enc_base = encrypt (key, base)
-        result += bytearray ([ a ^ b for (a,b) in zip (enc_base, bytearray (payload[i:i+16]))])
-        base[0] += 1
+    return bytearray ([ a ^ b for (a,b) in zip (keystream, bytearray (payload))])
 
-    return result
+def encrypt_blocks (key, value):
+    """
+    Same as encrypt, for a value holding any number of 16 bytes blocks.
+    """
+    assert key, 'No key set'
+    assert (len(key) == 16)
+    assert (len(value) % 16 == 0)
+    cipher = AES.new(bytes(key)[::-1], AES.MODE_ECB)
+    return bytearray (cipher.encrypt (bytes(value)[::-1])[::-1])
 
 def make_command_packet (key, address, dest_id, command, data):
     """
@@ -0,0 +1,172 @@
+import asyncio
+import itertools
+import logging
+
+logger = logging.getLogger(__name__)
+
+#: Priority classes, a lower value is sent first
+PRIORITY_INTERACTIVE = 0    #Commands triggered by a user
+PRIORITY_AUTOMATION = 1     #Commands triggered by automations, scripts, ...
+PRIORITY_BACKGROUND = 2     #Status polling and diagnostics
+
+class SchedulerStopped(ConnectionError):
+    """The scheduler was stopped, commands are no longer sent over this connection"""
+
+class SupersededCommandFailed(Exception):
+    """The command that replaced a superseded command failed, the error is the cause"""
+
+class _Command:
+    __slots__ = ('write', 'future', 'key', 'priority')
+
+    def __init__(self, write, future, key, priority):
+        self.write = write
+        self.future = future
+        self.key = key
+        self.priority = priority
+
+def _chain(replacing, superseded):
+    """Complete the future of a superseded command like the one of the command that replaced it"""
+    if superseded.done():
+        return
+    if replacing.cancelled():
+        superseded.cancel()
+    elif replacing.exception() is not None:
+        # Wrapped, only the caller of the replacing command retries
+        error = SupersededCommandFailed(str(replacing.exception()))
+        error.__cause__ = replacing.exception()
+        superseded.set_exception(error)
+    else:
+        superseded.set_result(replacing.result())
+
+class CommandScheduler:
+    """
+    Serializes all GATT operations of one connection.
+
+    Commands are executed one at a time by a single writer task, by priority
+    and in FIFO order within a priority. Callers await a future that completes
+    when their command has been executed, so there is no need to poll for a
+    free connection. A command waits at most for the command being executed
+    and the queued commands with the same or a higher priority.
+
+    Commands submitted with a key replace a queued command with the same key
+    (last writer wins): the old command is dropped, its future completes with
+    the result or error of the new command once that has been executed, and
+    the new command takes its place at the end of the queue.
+    """
+
+    def __init__(self, name):
+        """
+        Args :
+            name: Name used in log messages.
+        """
+        self._name = name
+        self._queue = asyncio.PriorityQueue()
+        self._order = itertools.count()
+        self._worker = None
+        self._pending = {}
+        self._lanes = [0, 0, 0]     #Number of queued commands per priority
+        self.superseded = 0
+        self.dropped = 0
+
+    @property
+    def depth(self) -> int:
+        """Number of commands waiting to be executed"""
+        return sum(self._lanes)
+
+    @property
+    def running(self) -> bool:
+        return self._worker is not None and not self._worker.done()
+
+    def busy(self, priority) -> bool:
+        """True when commands with a higher priority than priority are queued"""
+        return any(self._lanes[0:priority])
+
+    def start(self):
+        if self.running:
+            return
+        self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Stops the writer task and fails all commands still in the queue"""
+        worker = self._worker
+        self._worker = None
+        if worker is not None:
+            worker.cancel()
+            try:
+                await worker
+            except asyncio.CancelledError:
+                pass
+        self._pending.clear()
+        self._lanes = [0, 0, 0]
+        while not self._queue.empty():
+            _, _, command = self._queue.get_nowait()
+            if not command.future.done():
+                command.future.set_exception(SchedulerStopped(f'[{self._name}] Connection closed before command was sent'))
+
+    def submit(self, write, key=None, priority=PRIORITY_INTERACTIVE) -> asyncio.Future:
+        """
+        Args :
+            write: A callable without arguments returning the awaitable that
+                performs the GATT operation(s).
+            key: Optional hashable, a queued command with the same key is
+                superseded by this one.
+            priority: One of the PRIORITY_* classes.
+
+        Returns :
+            A future with the result of the awaitable.
+        """
+        future = asyncio.get_running_loop().create_future()
+        command = _Command(write, future, key, priority)
+        if key is not None:
+            previous = self._pending.get(key)
+            if previous is not None:
+                previous.write = None
+                self._lanes[previous.priority] -= 1
+                self.superseded += 1
+                future.add_done_callback(lambda replacing, superseded=previous.future: _chain(replacing, superseded))
+                logger.debug('[%s] Command %s superseded, %d in total', self._name, key, self.superseded)
+            self._pending[key] = command
+        self._lanes[priority] += 1
+        self._queue.put_nowait((priority, next(self._order), command))
+        return future
+
+    async def run(self, write, key=None, priority=PRIORITY_INTERACTIVE, drop_if_busy=False):
+        """
+        Submits write and waits for its result, see submit.
+
+        Args :
+            drop_if_busy: Do not submit write and return None when commands
+                with a higher priority are queued.
+        """
+        if not self.running:
+            raise SchedulerStopped(f'[{self._name}] Command scheduler is not running')
+        if drop_if_busy and self.busy(priority):
+            self.dropped += 1
+            logger.debug('[%s] Command %s dropped, higher priority commands queued', self._name, key)
+            return None
+        return await self.submit(write, key, priority)
+
+    async def _run(self):
+        while True:
+            _, _, command = await self._queue.get()
+            if command.write is None:  # Superseded by a newer command
+                continue
+            self._lanes[command.priority] -= 1
+            if command.key is not None and self._pending.get(command.key) is command:
+                del self._pending[command.key]
+            if command.future.done():  # Caller is no longer waiting
+                continue
+            try:
+                result = await command.write()
+            except asyncio.CancelledError:
+                # Stopped while writing, the caller gets the same error as the queued commands
+                if not command.future.done():
+                    command.future.set_exception(SchedulerStopped(f'[{self._name}] Connection closed while command was sent'))
+                raise
+            except Exception as err:
+                if not command.future.done():
+                    command.future.set_exception(err)
+            else:
+                if not command.future.done():
+                    command.future.set_result(result)
+            logger.debug('[%s] Command done, %d queued', self._name, self.depth)
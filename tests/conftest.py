@@ -0,0 +1,27 @@
+"""Shared helpers for the tests, run with `python -m pytest` from the repository root"""
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def run_with_hass():
+    """Run a coroutine function with a bare, not started HomeAssistant instance"""
+    from homeassistant.core import HomeAssistant
+
+    def run(test):
+        async def main():
+            with tempfile.TemporaryDirectory() as config_dir:
+                hass = HomeAssistant(config_dir)
+                try:
+                    return await test(hass)
+                finally:
+                    await hass.async_stop(force=True)
+        return asyncio.run(main())
+
+    return run
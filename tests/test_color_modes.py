@@ -0,0 +1,42 @@
+"""Color modes of the lights per deviceType of the cloud"""
+import pytest
+
+from homeassistant.components.light import ColorMode, valid_supported_color_modes
+
+from custom_components.zenggemesh.inventory import DEVICE_TYPE_DEFAULT, device_type_from_cloud
+from custom_components.zenggemesh.light import supported_color_modes_for
+
+
+@pytest.mark.parametrize('device_type, color_modes', [
+    (0x41, {ColorMode.RGB, ColorMode.COLOR_TEMP}),
+    (0x42, {ColorMode.RGB}),
+    (0x43, {ColorMode.RGB}),
+    (0x44, {ColorMode.COLOR_TEMP}),
+    (0x45, {ColorMode.BRIGHTNESS}),
+    (0x99, {ColorMode.ONOFF}),
+])
+def test_device_type_color_modes(device_type, color_modes):
+    supported = supported_color_modes_for(device_type_from_cloud(device_type))
+
+    assert supported == color_modes
+    assert valid_supported_color_modes(supported) == supported
+
+
+def test_default_type_is_on_off():
+    assert supported_color_modes_for(DEVICE_TYPE_DEFAULT) == {ColorMode.ONOFF}
+    assert supported_color_modes_for('') == {ColorMode.ONOFF}
+
+
+@pytest.mark.parametrize('member_types, color_modes', [
+    ((0x45, 0x44), {ColorMode.COLOR_TEMP}),
+    ((0x45, 0x43), {ColorMode.RGB}),
+    ((0x43, 0x44), {ColorMode.RGB, ColorMode.COLOR_TEMP}),
+    ((0x45, 0x99), {ColorMode.BRIGHTNESS}),
+])
+def test_group_color_modes(member_types, color_modes):
+    """Groups join the types of their members, like light.async_setup_entry does"""
+    type_string = ' '.join(device_type_from_cloud(device_type) for device_type in member_types)
+    supported = supported_color_modes_for(type_string)
+
+    assert supported == color_modes
+    assert valid_supported_color_modes(supported) == supported
@@ -0,0 +1,124 @@
+"""Routing of commands over the primary connection and the gateways"""
+import asyncio
+import time
+
+import pytest
+
+from custom_components.zenggemesh.zengge_mesh import ZenggeMesh
+from custom_components.zenggemesh.zenggemeshlight.scheduler import CommandScheduler, SchedulerStopped
+
+
+class FakeConnection:
+    """A logged in connection, every command takes write_time seconds"""
+
+    def __init__(self, mac, log, write_time=0.0):
+        self.mac = mac
+        self.is_connected = True
+        self._log = log
+        self._write_time = write_time
+        self._scheduler = CommandScheduler(mac)
+        self._scheduler.start()
+
+    @property
+    def queue_depth(self):
+        return self._scheduler.depth
+
+    async def _write(self, value, dest):
+        await asyncio.sleep(self._write_time)
+        self._log.append((self.mac, dest, value))
+
+    async def on(self, dest=None, priority=0):
+        return await self._scheduler.run(lambda: self._write('on', dest), (dest, 'power'), priority)
+
+    async def off(self, dest=None, priority=0):
+        return await self._scheduler.run(lambda: self._write('off', dest), (dest, 'power'), priority)
+
+    async def stop(self):
+        self.is_connected = False
+        await self._scheduler.stop()
+
+
+def make_mesh(hass, primary, gateways):
+    mesh = ZenggeMesh(hass, 'mesh', 'password', 'key', gateways=len(gateways))
+    mesh._connected_bluetooth_device = primary
+    now = time.monotonic()
+    for gateway in gateways:
+        mesh._gateways[gateway] = {}
+    mesh._devices[1] = {'mac': '', 'name': 'light', 'last_status': None, 'last_update': None}
+    mesh._reach[1] = {gateway: now for gateway in gateways}
+    return mesh
+
+
+def test_commands_for_a_light_keep_their_order_over_gateways(run_with_hass):
+    async def test(hass):
+        log = []
+        primary = FakeConnection('primary', log)
+        gateway = FakeConnection('gateway', log, write_time=0.05)
+        mesh = make_mesh(hass, primary, [gateway])
+        mesh._gateway_latency = {primary: 0.5, gateway: 0.01}
+
+        turn_on = asyncio.ensure_future(mesh.async_on(1))
+        await asyncio.sleep(0)
+        # The primary looks faster now, the next command must still follow the first one
+        mesh._gateway_latency = {primary: 0.001, gateway: 5}
+        turn_off = asyncio.ensure_future(mesh.async_off(1))
+        await asyncio.gather(turn_on, turn_off)
+
+        assert log == [('gateway', 1, 'on'), ('gateway', 1, 'off')]
+        assert mesh._pinned == {}
+
+    run_with_hass(test)
+
+
+def test_idle_light_moves_to_the_fastest_connection(run_with_hass):
+    async def test(hass):
+        log = []
+        primary = FakeConnection('primary', log)
+        gateway = FakeConnection('gateway', log)
+        mesh = make_mesh(hass, primary, [gateway])
+        mesh._gateway_latency = {primary: 0.5, gateway: 0.01}
+        await mesh.async_on(1)
+        mesh._gateway_latency = {primary: 0.001, gateway: 5}
+        await mesh.async_off(1)
+
+        assert log == [('gateway', 1, 'on'), ('primary', 1, 'off')]
+
+    run_with_hass(test)
+
+
+def test_pinned_connection_that_dropped_is_not_used(run_with_hass):
+    async def test(hass):
+        log = []
+        primary = FakeConnection('primary', log)
+        gateway = FakeConnection('gateway', log, write_time=0.05)
+        mesh = make_mesh(hass, primary, [gateway])
+        mesh._gateway_latency = {primary: 0.5, gateway: 0.01}
+
+        turn_on = asyncio.ensure_future(mesh.async_on(1))
+        await asyncio.sleep(0)
+        gateway.is_connected = False
+        await mesh.async_off(1)
+        await turn_on
+
+        assert ('primary', 1, 'off') in log
+
+    run_with_hass(test)
+
+
+def test_lost_primary_without_standby_is_stopped(run_with_hass):
+    async def test(hass):
+        log = []
+        primary = FakeConnection('primary', log, write_time=0.05)
+        mesh = make_mesh(hass, primary, [])
+
+        turn_on = asyncio.ensure_future(mesh.async_on(1))
+        await asyncio.sleep(0)
+        primary.is_connected = False
+        mesh._device_disconnected(primary)
+        await hass.async_block_till_done()
+
+        assert not primary._scheduler.running
+        with pytest.raises(SchedulerStopped):
+            await turn_on
+
+    run_with_hass(test)
@@ -0,0 +1,42 @@
+"""Frames sent by ZenggeLight.async_turn_on"""
+from homeassistant.components.light import ATTR_BRIGHTNESS, ATTR_RGB_COLOR, ColorMode
+
+from custom_components.zenggemesh.light import ZenggeLight
+from custom_components.zenggemesh.zengge_mesh import ZenggeMesh
+
+
+def make_light(hass, sent):
+    mesh = ZenggeMesh(hass, 'mesh', 'password', 'key')
+
+    async def set_state(mesh_id, rgb=None, brightness=None, white_temperature=None, priority=None):
+        sent.append((rgb, brightness, white_temperature))
+
+    mesh.async_set_state = set_state
+    return ZenggeLight(mesh, None, 1, 'light', {ColorMode.RGB, ColorMode.COLOR_TEMP}, 'Zengge', 'model', '1')
+
+
+def test_color_with_unchanged_brightness_skips_brightness_frame(run_with_hass):
+    async def test(hass):
+        sent = []
+        light = make_light(hass, sent)
+        await light.async_turn_on(**{ATTR_RGB_COLOR: (255, 0, 0), ATTR_BRIGHTNESS: 128})
+        await light.async_turn_on(**{ATTR_RGB_COLOR: (0, 255, 0), ATTR_BRIGHTNESS: 128})
+        await light.async_turn_on(**{ATTR_RGB_COLOR: (0, 0, 255), ATTR_BRIGHTNESS: 255})
+
+        assert sent == [((255, 0, 0), 51, None), ((0, 255, 0), None, None), ((0, 0, 255), 100, None)]
+        assert light.brightness == 255
+
+    run_with_hass(test)
+
+
+def test_color_on_light_that_is_off_sends_brightness(run_with_hass):
+    async def test(hass):
+        sent = []
+        light = make_light(hass, sent)
+        await light.async_turn_on(**{ATTR_RGB_COLOR: (255, 0, 0), ATTR_BRIGHTNESS: 128})
+        light.status_callback({'state': False})
+        await light.async_turn_on(**{ATTR_RGB_COLOR: (0, 255, 0), ATTR_BRIGHTNESS: 128})
+
+        assert sent[-1] == ((0, 255, 0), 51, None)
+
+    run_with_hass(test)
@@ -0,0 +1,45 @@
+"""Coalesced state writes of the light entities"""
+import asyncio
+
+from custom_components.zenggemesh.zengge_mesh import ZenggeMesh
+
+
+class FakeEntity:
+    def __init__(self, hass):
+        self.hass = hass
+        self.writes = 0
+
+    def async_write_ha_state(self):
+        self.writes += 1
+
+
+def test_burst_writes_state_once(run_with_hass):
+    async def test(hass):
+        mesh = ZenggeMesh(hass, 'mesh', 'password', 'key')
+        entity = FakeEntity(hass)
+        for _ in range(5):
+            mesh.async_schedule_state_write(entity)
+        await asyncio.sleep(0)
+
+        assert entity.writes == 1
+
+    run_with_hass(test)
+
+
+def test_removed_entity_is_forgotten(run_with_hass):
+    async def test(hass):
+        mesh = ZenggeMesh(hass, 'mesh', 'password', 'key')
+        written, removed = FakeEntity(hass), FakeEntity(hass)
+        mesh.async_schedule_state_write(written)
+        await asyncio.sleep(0)
+        mesh.async_schedule_state_write(removed)
+
+        mesh.async_forget_state_writes(written)
+        mesh.async_forget_state_writes(removed)
+        await asyncio.sleep(0)
+
+        assert removed.writes == 0
+        assert mesh._last_state_write == {}
+        assert mesh._dirty_entities == {}
+
+    run_with_hass(test)
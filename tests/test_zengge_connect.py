@@ -0,0 +1,94 @@
+"""Login on the cloud servers, against local stub servers"""
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from custom_components.zenggemesh.zengge_connect import ZenggeConnect, MAGICHUE_USER_LOGIN_ENDPOINT
+
+
+async def start_server(name, delay, accepts, hits):
+    """A cloud server that answers the login after delay seconds, returns (runner, url)"""
+    async def login(request):
+        hits.append(name)
+        await asyncio.sleep(delay)
+        if not accepts:
+            return web.json_response({'error': 'no such user'}, status=400)
+        return web.json_response({'result': {'userId': 'user', 'auth_token': 'token-' + name, 'deviceSecret': 'secret'}})
+
+    app = web.Application()
+    app.router.add_post('/' + MAGICHUE_USER_LOGIN_ENDPOINT, login)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, 'http://%s:%d/' % (host, port)
+
+
+def run_with_servers(test, servers):
+    async def main():
+        hits = []
+        started = [await start_server(name, delay, accepts, hits) for name, delay, accepts in servers]
+        try:
+            async with aiohttp.ClientSession() as session:
+                await test(session, [url for _, url in started], hits)
+        finally:
+            for runner, _ in started:
+                await runner.cleanup()
+    asyncio.run(main())
+
+
+def test_probe_uses_fastest_server_that_accepts():
+    async def test(session, urls, hits):
+        connect = ZenggeConnect(session, 'user', 'password', servers=urls)
+        await connect.login()
+
+        assert connect.server == urls[2]
+        assert connect._auth_token == 'token-mid'
+
+    run_with_servers(test, [('refuses', 0, False), ('slow', 0.5, True), ('mid', 0.1, True)])
+
+
+def test_known_server_is_tried_first():
+    async def test(session, urls, hits):
+        connect = ZenggeConnect(session, 'user', 'password', servers=urls, server=urls[1])
+        await connect.login()
+
+        assert connect.server == urls[1]
+        assert hits == ['slow']
+
+    run_with_servers(test, [('refuses', 0, False), ('slow', 0.2, True)])
+
+
+def test_probe_raises_when_no_server_accepts():
+    async def test(session, urls, hits):
+        connect = ZenggeConnect(session, 'user', 'password', servers=urls)
+        with pytest.raises(Exception):
+            await connect.login()
+
+    run_with_servers(test, [('refuses', 0, False), ('refuses too', 0.1, False)])
+
+
+def test_probe_finishes_losing_attempts():
+    async def main():
+        finished = []
+
+        async def login(server):
+            try:
+                if server == 'slow':
+                    await asyncio.sleep(10)
+                if server == 'refuses':
+                    raise Exception('Login failed')
+                return {'userId': 'user', 'auth_token': 'token', 'deviceSecret': 'secret'}
+            finally:
+                finished.append(server)
+
+        connect = ZenggeConnect(None, 'user', 'password', servers=['slow', 'accepts', 'refuses'])
+        connect._login = login
+        assert (await connect._probe_servers())[0] == 'accepts'
+        # No login request is left running and no error is left unretrieved
+        assert sorted(finished) == ['accepts', 'refuses', 'slow']
+
+    asyncio.run(main())